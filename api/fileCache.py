@@ -0,0 +1,265 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+from api.fileSpool import FileSpool
+from utils.Logger import logger
+from utils.config import file_cache_size, file_cache_memory, file_cache_max_object
+
+
+def parse_cache_control(value):
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, arg = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip('"')
+    return directives
+
+
+def parse_http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except Exception:
+        return None
+
+
+def freshness_lifetime(headers, now):
+    directives = parse_cache_control(headers.get("cache-control"))
+    if "no-store" in directives or "private" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0
+    for name in ("s-maxage", "max-age"):
+        if directives.get(name, "").isdigit():
+            return int(directives[name])
+    expires = parse_http_date(headers.get("expires", ""))
+    if headers.get("expires"):
+        return max(expires - now, 0) if expires else 0
+    last_modified = parse_http_date(headers.get("last-modified", ""))
+    if last_modified:
+        # heuristic freshness, as caches commonly do: a tenth of the document's age, at most a day
+        return min(max(now - last_modified, 0) / 10, 86400)
+    return 0
+
+
+class FileCache:
+    # keeps fetched attachments in memory and on disk, revalidating stale entries with ETag / Last-Modified
+    def __init__(self, path, max_bytes=256 << 20, memory_bytes=32 << 20, max_object_size=20 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.max_object_size = max_object_size
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.index = OrderedDict()
+        self.disk_size = 0
+        self.fetches = {}
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        if self.max_bytes:
+            self.load_index()
+
+    def load_index(self):
+        os.makedirs(self.path, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.path, name), "r") as f:
+                    entries.append(json.load(f))
+            except Exception:
+                continue
+        for entry in sorted(entries, key=lambda e: e.get("stored_at", 0)):
+            key = entry.get("key")
+            if key and os.path.exists(os.path.join(self.path, key)):
+                self.index[key] = entry
+                self.disk_size += entry["size"]
+        self.evict()
+
+    @staticmethod
+    def key_of(url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    async def get(self, url, fetch):
+        key = self.key_of(url)
+        flight = self.fetches.get(key)
+        if flight is None:
+            flight = {"task": asyncio.create_task(self.lookup(key, url, fetch)), "waiters": 0}
+            self.fetches[key] = flight
+            flight["task"].add_done_callback(lambda _: self.fetches.pop(key, None))
+        else:
+            self.coalesced += 1
+        task = flight["task"]
+        flight["waiters"] += 1
+        # concurrent requests for the same URL share one download, a cancelled waiter must not cancel it for the others
+        try:
+            spool, mime_type = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            flight["waiters"] -= 1
+            task.add_done_callback(lambda t: self.release_orphan(t, flight))
+            raise
+        except BaseException:
+            flight["waiters"] -= 1
+            raise
+        # every waiter gets its own reference, the last one to wake takes over the fetch's
+        flight["waiters"] -= 1
+        if spool is not None and flight["waiters"]:
+            spool.acquire()
+        return spool, mime_type
+
+    @staticmethod
+    def release_orphan(task, flight):
+        if flight["waiters"] or task.cancelled() or task.exception():
+            return
+        spool, _ = task.result()
+        if spool is not None:
+            spool.close()
+
+    async def lookup(self, key, url, fetch):
+        entry = self.index.get(key)
+        cached = self.open(key, entry) if entry else None
+        if entry and cached is None:
+            self.remove(key)
+            entry = None
+        now = time.time()
+        if entry and entry["expires"] > now:
+            self.hits += 1
+            self.index.move_to_end(key)
+            return cached, entry["mime_type"]
+
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            status_code, body, response_headers = await fetch(url, headers)
+        except BaseException:
+            if cached is not None:
+                cached.close()
+            raise
+        now = time.time()
+        if status_code == 304 and entry:
+            self.revalidated += 1
+            if body is not None:
+                body.close()
+            lifetime = freshness_lifetime(response_headers, now)
+            entry["expires"] = now + (lifetime or 0)
+            entry["etag"] = response_headers.get("etag") or entry.get("etag")
+            entry["last_modified"] = response_headers.get("last-modified") or entry.get("last_modified")
+            self.index.move_to_end(key)
+            await asyncio.to_thread(self.write_entry, entry)
+            return cached, entry["mime_type"]
+        if cached is not None:
+            cached.close()
+        self.misses += 1
+        if status_code != 200 or body is None:
+            if body is not None:
+                body.close()
+            return None, None
+        mime_type = response_headers.get("content-type", "").split(";")[0].strip()
+        lifetime = freshness_lifetime(response_headers, now)
+        etag, last_modified = response_headers.get("etag"), response_headers.get("last-modified")
+        if self.max_bytes and lifetime is not None and (lifetime or etag or last_modified) and len(body) <= self.max_object_size:
+            await self.store(key, url, body, mime_type, now + lifetime, etag, last_modified)
+        elif entry:
+            self.remove(key)
+        return body, mime_type
+
+    def open(self, key, entry):
+        if not entry.get("digest"):
+            return None
+        digest = bytes.fromhex(entry["digest"])
+        content = self.memory.get(key)
+        if content is not None:
+            self.memory.move_to_end(key)
+            return FileSpool.from_bytes(content, digest)
+        try:
+            return FileSpool.from_file(os.path.join(self.path, key), entry["size"], digest)
+        except OSError:
+            return None
+
+    def remember(self, key, content):
+        if len(content) > self.memory_bytes:
+            return
+        if key in self.memory:
+            self.memory_size -= len(self.memory.pop(key))
+        self.memory[key] = content
+        self.memory_size += len(content)
+        while self.memory_size > self.memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_size -= len(evicted)
+
+    async def store(self, key, url, spool, mime_type, expires, etag, last_modified):
+        entry = {"key": key, "url": url, "mime_type": mime_type, "size": len(spool), "digest": spool.digest.hex(),
+                 "expires": expires, "etag": etag, "last_modified": last_modified, "stored_at": time.time()}
+        try:
+            await asyncio.to_thread(self.write_file, key, spool, entry)
+        except OSError as e:
+            logger.error(f"Failed to cache file {url}: {e}")
+            return
+        if key in self.index:
+            self.disk_size -= self.index.pop(key)["size"]
+        self.index[key] = entry
+        self.disk_size += entry["size"]
+        # only attachments that never left memory while downloading are kept in memory
+        if spool.file is None:
+            self.remember(key, spool.getvalue())
+        self.evict()
+
+    def write_file(self, key, spool, entry):
+        tmp_path = os.path.join(self.path, key + ".tmp")
+        with open(tmp_path, "wb") as f:
+            for offset in range(0, len(spool), 1 << 20):
+                f.write(spool.read_at(offset, 1 << 20))
+        os.replace(tmp_path, os.path.join(self.path, key))
+        self.write_entry(entry)
+
+    def write_entry(self, entry):
+        tmp_path = os.path.join(self.path, entry["key"] + ".json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, os.path.join(self.path, entry["key"] + ".json"))
+
+    def remove(self, key):
+        entry = self.index.pop(key, None)
+        if entry:
+            self.disk_size -= entry["size"]
+        if key in self.memory:
+            self.memory_size -= len(self.memory.pop(key))
+        for name in (key, key + ".json"):
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    def evict(self):
+        while self.disk_size > self.max_bytes and self.index:
+            self.remove(next(iter(self.index)))
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.revalidated + self.misses
+        return {
+            "entries": len(self.index),
+            "disk_bytes": self.disk_size,
+            "memory_bytes": self.memory_size,
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.revalidated) / lookups, 4) if lookups else 0,
+        }
+
+
+file_cache = FileCache(os.path.join("data", "file_cache"), max_bytes=file_cache_size << 20,
+                       memory_bytes=file_cache_memory << 20, max_object_size=file_cache_max_object << 20)
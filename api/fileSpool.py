@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import io
+import os
+import tempfile
+
+from utils.config import file_spool_memory
+
+HEAD_SIZE = 32
+
+
+class FileSpool:
+    # attachment bytes stay in memory up to max_memory and then move to an unnamed temp file; reads are positional,
+    # so requests sharing one download never race over a file offset
+    def __init__(self, max_memory=file_spool_memory << 20):
+        self.max_memory = max_memory
+        self.buffer = bytearray()
+        self.file = None
+        self.size = 0
+        self.hash = hashlib.sha256()
+        self.digest = None
+        self.head = b""
+        self.refs = 1
+
+    @classmethod
+    def from_bytes(cls, content, digest=None):
+        spool = cls(max_memory=len(content))
+        spool.buffer = content
+        spool.size = len(content)
+        spool.head = content[:HEAD_SIZE]
+        spool.digest = digest or hashlib.sha256(content).digest()
+        return spool
+
+    @classmethod
+    def from_file(cls, path, size, digest):
+        spool = cls(max_memory=0)
+        spool.file = open(path, "rb")
+        spool.size = size
+        spool.head = spool.read_at(0, HEAD_SIZE)
+        spool.digest = digest
+        return spool
+
+    def write(self, chunk):
+        self.hash.update(chunk)
+        if len(self.head) < HEAD_SIZE:
+            self.head += bytes(chunk[:HEAD_SIZE - len(self.head)])
+        if self.file is None and self.size + len(chunk) > self.max_memory:
+            self.file = tempfile.TemporaryFile()
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+        if self.file is None:
+            self.buffer += chunk
+        else:
+            self.file.write(chunk)
+        self.size += len(chunk)
+
+    def finish(self):
+        self.digest = self.hash.digest()
+        if self.file is not None:
+            self.file.flush()
+        return self
+
+    def read_at(self, offset, size):
+        if self.file is None:
+            return bytes(self.buffer[offset:offset + size])
+        return os.pread(self.file.fileno(), size, offset)
+
+    async def blocks(self, block_size):
+        for offset in range(0, self.size, block_size):
+            if self.file is None:
+                yield self.read_at(offset, block_size)
+            else:
+                yield await asyncio.to_thread(self.read_at, offset, block_size)
+
+    def getvalue(self):
+        if self.file is None and isinstance(self.buffer, bytes):
+            return self.buffer
+        return self.read_at(0, self.size)
+
+    def reader(self):
+        return io.BufferedReader(SpoolReader(self))
+
+    def acquire(self):
+        self.refs += 1
+        return self
+
+    def close(self):
+        self.refs -= 1
+        if self.refs > 0:
+            return
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.buffer = b""
+
+    def __len__(self):
+        return self.size
+
+
+class SpoolReader(io.RawIOBase):
+    def __init__(self, spool):
+        self.spool = spool
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.spool.read_at(self.position, min(len(buffer), max(self.spool.size - self.position, 0)))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.spool.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+
+def sniff_mime_type(head):
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head.startswith(b"%PDF-"):
+        return "application/pdf"
+    return None
@@ -1,33 +1,49 @@
-import io
-
 import pybase64
 from PIL import Image
 
+from api.fileCache import file_cache
+from api.fileSpool import FileSpool, sniff_mime_type
+from api.requestBody import InlineFile
 from utils.Client import Client
 from utils.config import export_proxy_url, cf_file_url
 
 
 async def get_file_content(url):
-    if url.startswith("data:"):
+    if isinstance(url, InlineFile):
+        return url.spool.acquire(), url.mime_type
+    elif url.startswith("data:"):
         mime_type, base64_data = url.split(';')[0].split(':')[1], url.split(',')[1]
-        file_content = pybase64.b64decode(base64_data)
+        file_content = FileSpool.from_bytes(pybase64.b64decode(base64_data))
         return file_content, mime_type
     else:
-        client = Client()
+        file_content, mime_type = await file_cache.get(url, fetch_file)
+        if file_content is not None:
+            mime_type = sniff_mime_type(file_content.head) or mime_type
+        return file_content, mime_type
+
+
+async def fetch_file(url, headers):
+    client = Client()
+    try:
+        if cf_file_url:
+            body = {"file_url": url}
+            r = await client.request("POST", cf_file_url, headers=headers, timeout=60, json=body, stream=True)
+        else:
+            r = await client.request("GET", url, headers=headers, proxy=export_proxy_url, timeout=60, stream=True)
+        response_headers = {key.lower(): value for key, value in r.headers.items()}
+        if r.status_code != 200:
+            return r.status_code, None, response_headers
+        file_content = FileSpool()
         try:
-            if cf_file_url:
-                body = {"file_url": url}
-                r = await client.post(cf_file_url, timeout=60, json=body)
-            else:
-                r = await client.get(url, proxy=export_proxy_url, timeout=60)
-            if r.status_code != 200:
-                return None, None
-            file_content = r.content
-            mime_type = r.headers.get('Content-Type', '').split(';')[0].strip()
-            return file_content, mime_type
-        finally:
-            await client.close()
-            del client
+            async for chunk in r.aiter_content():
+                file_content.write(chunk)
+        except BaseException:
+            file_content.close()
+            raise
+        return r.status_code, file_content.finish(), response_headers
+    finally:
+        await client.close()
+        del client
 
 
 async def determine_file_use_case(mime_type):
@@ -49,7 +65,8 @@ async def determine_file_use_case(mime_type):
 
 
 async def get_image_size(file_content):
-    with Image.open(io.BytesIO(file_content)) as img:
+    # only the header is parsed, the pixels are never read
+    with Image.open(file_content.reader()) as img:
         return img.width, img.height
 
 
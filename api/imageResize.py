@@ -0,0 +1,119 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+from api.fileSpool import FileSpool
+from api.tokens import scaled_image_size
+from utils.Logger import logger
+from utils.config import image_downscale, image_workers
+
+LOW_DETAIL_SIZE = 512
+FORMATS = {"image/jpeg": "JPEG", "image/png": "PNG", "image/webp": "WEBP"}
+
+
+def target_size(width, height, detail):
+    if detail == "low":
+        scale_factor = min(LOW_DETAIL_SIZE / max(width, height), 1)
+        return max(int(width * scale_factor), 1), max(int(height * scale_factor), 1)
+    width, height = scaled_image_size(width, height)
+    return max(width, 1), max(height, 1)
+
+
+def resize_image(file_content, mime_type, detail):
+    with Image.open(file_content.reader()) as img:
+        if getattr(img, "n_frames", 1) > 1:
+            return None
+        orientation = img.getexif().get(0x0112, 1)
+        width, height = (img.height, img.width) if orientation in (5, 6, 7, 8) else img.size
+        size = target_size(width, height, detail)
+        if size[0] >= width and size[1] >= height:
+            return None
+        if img.format == "JPEG":
+            # libjpeg decodes straight at a reduced scale, the full-size photo is never materialised
+            img.draft("RGB", (size[1], size[0]) if orientation in (5, 6, 7, 8) else size)
+        img = ImageOps.exif_transpose(img)
+        img = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        if FORMATS[mime_type] == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        resized = FileSpool()
+        writer = SpoolWriter(resized)
+        if FORMATS[mime_type] == "PNG":
+            img.save(writer, "PNG", optimize=False, compress_level=6)
+        else:
+            img.save(writer, FORMATS[mime_type], quality=85)
+        resized.finish()
+    if len(resized) >= len(file_content):
+        resized.close()
+        return None
+    return resized, size
+
+
+class SpoolWriter:
+    def __init__(self, spool):
+        self.spool = spool
+
+    def write(self, data):
+        self.spool.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class ImageResizer:
+    # Pillow releases the GIL while decoding, resampling and encoding, so threads give real parallelism here
+    # without copying the attachment into another process
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.executor = None
+        self.resized = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.total_time = 0.0
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image-resize")
+        return self.executor
+
+    async def resize(self, file_content, mime_type, detail):
+        if mime_type not in FORMATS:
+            return None
+        start = time.perf_counter()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.get_executor(), resize_image, file_content, mime_type, detail
+            )
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"Failed to downscale image, uploading the original: {e}")
+            return None
+        if result is None:
+            self.skipped += 1
+            return None
+        self.resized += 1
+        self.bytes_in += len(file_content)
+        self.bytes_out += len(result[0])
+        self.total_time += time.perf_counter() - start
+        logger.info(f"Downscaled image to {result[1][0]}x{result[1][1]}: {len(file_content)} -> {len(result[0])} "
+                    f"bytes in {int((time.perf_counter() - start) * 1e6) / 1e3}ms")
+        return result
+
+    def stats(self):
+        return {
+            "enabled": image_downscale,
+            "workers": self.workers,
+            "resized": self.resized,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "avg_ms": round(self.total_time / self.resized * 1e3, 3) if self.resized else 0,
+        }
+
+
+image_resizer = ImageResizer(workers=image_workers)
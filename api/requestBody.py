@@ -0,0 +1,139 @@
+import re
+import uuid
+from collections import namedtuple
+
+import orjson
+import pybase64
+
+from api.fileSpool import FileSpool
+
+InlineFile = namedtuple("InlineFile", ["mime_type", "spool"])
+
+URL_KEY = re.compile(rb'"url"\s*:\s*"$')
+STRING_END = re.compile(rb'["\\]')
+DATA_URL = re.compile(rb'data:([^;,"\\]*)(?:;[^;,"\\]*)*;base64,')
+HEADER_MAX = 256
+BASE64_CHARS = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="
+NON_BASE64_CHARS = bytes(set(range(256)) - set(BASE64_CHARS))
+DECODE_SIZE = 64 * 1024
+
+
+class RequestBodyParser:
+    # scans the raw JSON body once; base64 data URLs under a "url" key are decoded chunk by chunk into spools and
+    # only a short placeholder is left for orjson, so a large image is never held as a JSON string
+    def __init__(self):
+        self.out = bytearray()
+        self.mode = "json"
+        self.carry = b""
+        self.token = f"inline-file:{uuid.uuid4().hex}:"
+        self.files = []
+        self.base64 = bytearray()
+
+    def feed(self, chunk, final=False):
+        data = self.carry + chunk if self.carry else chunk
+        self.carry = b""
+        view = memoryview(data)
+        pos, n = 0, len(data)
+        while pos < n:
+            if self.mode == "json":
+                quote = data.find(b'"', pos)
+                if quote < 0:
+                    self.out += view[pos:]
+                    break
+                self.out += view[pos:quote + 1]
+                pos = quote + 1
+                self.mode = "header" if URL_KEY.search(self.out, max(len(self.out) - 64, 0)) else "string"
+            elif self.mode == "header":
+                match = DATA_URL.match(data, pos)
+                if match:
+                    self.files.append(InlineFile(match.group(1).decode("ascii", "replace"), FileSpool()))
+                    self.out += f"{self.token}{len(self.files) - 1}".encode()
+                    self.mode = "data"
+                    pos = match.end()
+                elif not final and n - pos < HEADER_MAX and data.find(b'"', pos) < 0:
+                    self.carry = data[pos:]
+                    break
+                else:
+                    self.mode = "string"
+            else:
+                match = STRING_END.search(data, pos)
+                end = match.start() if match else n
+                if self.mode == "data":
+                    self.decode(view[pos:end])
+                else:
+                    self.out += view[pos:end]
+                if not match:
+                    break
+                if data[end] == ord('"'):
+                    if self.mode == "data":
+                        self.decode(b"", final=True)
+                        self.out += b'"'
+                    else:
+                        self.out += b'"'
+                    self.mode = "json"
+                    pos = end + 1
+                elif end + 1 >= n:
+                    self.carry = data[end:]
+                    break
+                else:
+                    if self.mode == "data":
+                        # "\/" is the only escape that can stand for a base64 character, line breaks are skipped
+                        if data[end + 1] == ord("/"):
+                            self.decode(b"/")
+                        elif data[end + 1] not in b"nrt":
+                            raise ValueError("Unsupported escape in data URL")
+                    else:
+                        self.out += view[end:end + 2]
+                    pos = end + 2
+        if final and (self.carry or self.mode != "json"):
+            raise ValueError("Unterminated JSON string")
+
+    def decode(self, chunk, final=False):
+        self.base64 += chunk
+        if not final and len(self.base64) < DECODE_SIZE:
+            return
+        if self.base64.translate(None, BASE64_CHARS):
+            self.base64 = self.base64.translate(None, NON_BASE64_CHARS)
+        spool = self.files[-1].spool
+        if final:
+            if len(self.base64) % 4:
+                self.base64 += b"=" * (4 - len(self.base64) % 4)
+            spool.write(pybase64.b64decode(self.base64))
+            self.base64 = bytearray()
+            spool.finish()
+            return
+        size = len(self.base64) - len(self.base64) % 4
+        with memoryview(self.base64) as view:
+            spool.write(pybase64.b64decode(view[:size]))
+        del self.base64[:size]
+
+    def result(self):
+        data = orjson.loads(self.out)
+        self.out = bytearray()
+        return self.resolve(data) if self.files else data
+
+    def resolve(self, value):
+        if isinstance(value, str) and value.startswith(self.token):
+            return self.files[int(value[len(self.token):])]
+        if isinstance(value, dict):
+            return {key: self.resolve(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.resolve(item) for item in value]
+        return value
+
+    def close(self):
+        for file in self.files:
+            file.spool.close()
+
+
+async def parse_request_body(stream):
+    parser = RequestBodyParser()
+    try:
+        async for chunk in stream:
+            if chunk:
+                parser.feed(chunk)
+        parser.feed(b"", final=True)
+        return parser.result(), parser
+    except BaseException:
+        parser.close()
+        raise
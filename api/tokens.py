@@ -1,32 +1,32 @@
+import asyncio
+import hashlib
 import math
+from collections import OrderedDict
 
+import regex
 import tiktoken
 
+from utils.Logger import logger
+
+
+def scaled_image_size(width, height):
+    # the resolution upstream works at: fit in 2048 x 2048, then shortest side at most 768
+    max_dimension = max(width, height)
+    if max_dimension > 2048:
+        scale_factor = 2048 / max_dimension
+        width, height = int(width * scale_factor), int(height * scale_factor)
+    min_dimension = min(width, height)
+    if min_dimension > 768:
+        scale_factor = 768 / min_dimension
+        width, height = int(width * scale_factor), int(height * scale_factor)
+    return width, height
+
 
 async def calculate_image_tokens(width, height, detail):
     if detail == "low":
         return 85
     else:
-        max_dimension = max(width, height)
-        if max_dimension > 2048:
-            scale_factor = 2048 / max_dimension
-            new_width = int(width * scale_factor)
-            new_height = int(height * scale_factor)
-        else:
-            new_width = width
-            new_height = height
-
-        width, height = new_width, new_height
-        min_dimension = min(width, height)
-        if min_dimension > 768:
-            scale_factor = 768 / min_dimension
-            new_width = int(width * scale_factor)
-            new_height = int(height * scale_factor)
-        else:
-            new_width = width
-            new_height = height
-
-        width, height = new_width, new_height
+        width, height = scaled_image_size(width, height)
         num_masks_w = math.ceil(width / 512)
         num_masks_h = math.ceil(height / 512)
         total_masks = num_masks_w * num_masks_h
@@ -37,11 +37,76 @@ async def calculate_image_tokens(width, height, detail):
         return total_tokens
 
 
+encodings = {}
+tokenizer_state = {"ready": False, "error": None}
+
+
+def get_encoding(model=None):
+    encoding = encodings.get(model)
+    if encoding is None:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+        encodings[model] = encoding
+    return encoding
+
+
+async def warmup_encodings(names=("cl100k_base", "o200k_base"), retry_interval=60):
+    while True:
+        try:
+            for name in names:
+                encoding = await asyncio.to_thread(tiktoken.get_encoding, name)
+                encoding.encode_ordinary("warmup")
+            tokenizer_state.update(ready=True, error=None)
+            logger.info(f"Tiktoken encodings loaded: {', '.join(names)}")
+            return
+        except Exception as e:
+            tokenizer_state["error"] = str(e)
+            logger.error(f"Failed to load tiktoken encodings, retry in {retry_interval}s: {e}")
+            await asyncio.sleep(retry_interval)
+
+
+class TokenCountCache:
+    def __init__(self, max_size=8192, offload_chars=16384):
+        self.max_size = max_size
+        self.offload_chars = offload_chars
+        self.counts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def count(self, encoding, text):
+        key = (encoding.name, hashlib.sha1(text.encode("utf-8", "surrogatepass")).digest())
+        count = self.counts.get(key)
+        if count is not None:
+            self.counts.move_to_end(key)
+            self.hits += 1
+            return count
+        self.misses += 1
+        if len(text) >= self.offload_chars:
+            count = len(await asyncio.to_thread(encoding.encode_ordinary, text))
+        else:
+            count = len(encoding.encode_ordinary(text))
+        self.counts[key] = count
+        while len(self.counts) > self.max_size:
+            self.counts.popitem(last=False)
+        return count
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.counts),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+        }
+
+
+token_count_cache = TokenCountCache()
+
+
 async def num_tokens_from_messages(messages, model=''):
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
+    encoding = get_encoding(model)
     if model == "gpt-3.5-turbo-0301":
         tokens_per_message = 4
     else:
@@ -53,34 +118,54 @@ async def num_tokens_from_messages(messages, model=''):
             if isinstance(value, list):
                 for item in value:
                     if item.get("type") == "text":
-                        num_tokens += len(encoding.encode(item.get("text")))
+                        num_tokens += await token_count_cache.count(encoding, item.get("text"))
                     if item.get("type") == "image_url":
                         pass
             else:
-                num_tokens += len(encoding.encode(value))
+                num_tokens += await token_count_cache.count(encoding, value)
     num_tokens += 3
     return num_tokens
 
 
-async def num_tokens_from_content(content, model=None):
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    encoded_content = encoding.encode(content)
-    len_encoded_content = len(encoded_content)
-    return len_encoded_content
-
-
-async def split_tokens_from_content(content, max_tokens, model=None):
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    encoded_content = encoding.encode(content)
-    len_encoded_content = len(encoded_content)
-    if len_encoded_content >= max_tokens:
-        content = encoding.decode(encoded_content[:max_tokens])
-        return content, max_tokens, "length"
-    else:
-        return content, len_encoded_content, "stop"
+class CompletionTokenCounter:
+    # BPE merges never cross the encoding's pre-token boundaries, so only the trailing pieces that more text
+    # could still change are re-encoded on each delta
+    def __init__(self, model=None, max_tokens=2147483647, encoding=None):
+        self.encoding = encoding or get_encoding(model)
+        # _pat_str is not public API: without it every delta re-encodes the whole uncommitted buffer
+        pat_str = getattr(self.encoding, "_pat_str", None)
+        self.pattern = regex.compile(pat_str) if pat_str else None
+        self.max_tokens = max_tokens
+        self.counted = 0
+        self.pending = ""
+        self.pending_tokens = 0
+        self.reached = False
+
+    @property
+    def tokens(self):
+        return self.counted + self.pending_tokens
+
+    def feed(self, text):
+        if self.reached or not text:
+            return ""
+        buffer = self.pending + text
+        pieces = [match.group() for match in self.pattern.finditer(buffer)] if self.pattern else [buffer]
+        boundary = len(buffer) - len("".join(pieces[-2:]))
+        counted = self.counted + sum(len(self.encoding.encode_ordinary(piece)) for piece in pieces[:-2])
+        pending_tokens = len(self.encoding.encode_ordinary(buffer[boundary:]))
+        if counted + pending_tokens < self.max_tokens:
+            self.counted, self.pending, self.pending_tokens = counted, buffer[boundary:], pending_tokens
+            return text
+        # the limit falls inside this delta: keep at most max_tokens of what was generated so far
+        allowed = self.encoding.encode_ordinary(buffer)[:self.max_tokens - self.counted]
+        kept = self.encoding.decode_bytes(allowed).decode("utf-8", errors="ignore")
+        text = kept[len(self.pending):]
+        # decoded text can encode into more tokens than it was cut from, e.g. runs of whitespace
+        count = len(self.encoding.encode_ordinary(self.pending + text))
+        while text and self.counted + count > self.max_tokens:
+            text = text[:-1]
+            count = len(self.encoding.encode_ordinary(self.pending + text))
+        self.counted += count
+        self.pending, self.pending_tokens = "", 0
+        self.reached = True
+        return text
@@ -1,10 +1,12 @@
 import uvicorn
 
-log_config = uvicorn.config.LOGGING_CONFIG
-default_format = "%(asctime)s | %(levelname)s | %(message)s"
-access_format = r'%(asctime)s | %(levelname)s | %(client_addr)s: %(request_line)s %(status_code)s'
-log_config["formatters"]["default"]["fmt"] = default_format
-log_config["formatters"]["access"]["fmt"] = access_format
+if __name__ == "__main__":
+    # guarded so that spawned proof-of-work workers do not start another server
+    log_config = uvicorn.config.LOGGING_CONFIG
+    default_format = "%(asctime)s | %(levelname)s | %(message)s"
+    access_format = r'%(asctime)s | %(levelname)s | %(client_addr)s: %(request_line)s %(status_code)s'
+    log_config["formatters"]["default"]["fmt"] = default_format
+    log_config["formatters"]["access"]["fmt"] = access_format
 
-uvicorn.run("chat2api:app", host="0.0.0.0", port=5005)
-# uvicorn.run("chat2api:app", host="0.0.0.0", port=5005, ssl_keyfile="key.pem", ssl_certfile="cert.pem")
+    uvicorn.run("chat2api:app", host="0.0.0.0", port=5005)
+    # uvicorn.run("chat2api:app", host="0.0.0.0", port=5005, ssl_keyfile="key.pem", ssl_certfile="cert.pem")
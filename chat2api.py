@@ -3,7 +3,6 @@ import time
 import types
 import warnings
 
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from fastapi import FastAPI, Request, Depends, HTTPException, Form
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse
@@ -13,20 +12,29 @@ from fastapi.templating import Jinja2Templates
 from starlette.background import BackgroundTask
 from starlette.responses import RedirectResponse, Response
 
+from api.requestBody import parse_request_body
+from api.tokens import token_count_cache, tokenizer_state, warmup_encodings
 from chatgpt.ChatService import ChatService
-from chatgpt.authorization import refresh_all_tokens, verify_token, get_req_token
-from chatgpt.authorization import refresh_all_tokens, verify_token, get_req_token
+from chatgpt.refreshScheduler import refresh_scheduler
+from chatgpt.refreshToken import rt2ac
+from chatgpt.proofofWork import pow_solver, warm_dpl
+from chatgpt.requirementsPool import requirements_pool
+from chatgpt.sentinelPrefetch import sentinel_prefetcher
+from chatgpt.uploadCache import upload_cache
+from api.fileCache import file_cache
+from api.imageResize import image_resizer
+from chatgpt import tokenCapability
 import chatgpt.globals as globals
+from chatgpt.stateStore import write_line_file
 from chatgpt.reverseProxy import chatgpt_reverse_proxy
 from utils.Logger import logger
-from utils.config import api_prefix, scheduled_refresh, authorization_list
+from utils.Client import session_pool
 from utils.config import api_prefix, scheduled_refresh, enable_gateway
 from utils.retry import async_retry
 
 warnings.filterwarnings("ignore")
 
 app = FastAPI()
-scheduler = AsyncIOScheduler()
 templates = Jinja2Templates(directory="templates")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
@@ -41,11 +49,17 @@ app.add_middleware(
 
 @app.on_event("startup")
 async def app_start():
+    app.state.tokenizer_warmup = asyncio.create_task(warmup_encodings())
+    pow_solver.warmup()
+    warm_dpl("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36")
+    requirements_pool.start()
     if scheduled_refresh:
-        scheduler.add_job(id='refresh', func=refresh_all_tokens, trigger='cron', hour=3, minute=0, day='*/4',
-                          kwargs={'force_refresh': True})
-        scheduler.start()
-        asyncio.get_event_loop().call_later(0, lambda: asyncio.create_task(refresh_all_tokens(force_refresh=False)))
+        refresh_scheduler.start(globals.token_pool.available_tokens(), rt2ac)
+
+
+@app.on_event("shutdown")
+async def app_stop():
+    pow_solver.shutdown()
 
 
 async def to_send_conversation(request_data, req_token):
@@ -56,7 +70,10 @@ async def to_send_conversation(request_data, req_token):
         return chat_service
     except HTTPException as e:
         await chat_service.close_client()
-        raise HTTPException(status_code=e.status_code, detail=e.detail)
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
+    except asyncio.CancelledError:
+        await chat_service.close_client()
+        raise
     except Exception as e:
         await chat_service.close_client()
         logger.error(f"Server error, {str(e)}")
@@ -65,18 +82,54 @@ async def to_send_conversation(request_data, req_token):
 
 async def process(request_data, req_token):
     chat_service = await to_send_conversation(request_data, req_token)
-    await chat_service.prepare_send_conversation()
-    res = await chat_service.send_conversation()
-    return chat_service, res
+    try:
+        await chat_service.prepare_send_conversation()
+        res = await chat_service.send_conversation()
+        return chat_service, res
+    except (Exception, asyncio.CancelledError):
+        await chat_service.close_client()
+        raise
+
+
+async def wait_for_disconnect(request: Request):
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def process_until_disconnect(request: Request, request_data, req_token):
+    task = asyncio.create_task(async_retry(process, request_data, req_token))
+    watcher = asyncio.create_task(wait_for_disconnect(request))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+            logger.info("Client disconnected, request cancelled.")
+    if task.cancelled():
+        raise HTTPException(status_code=499, detail="Client disconnected")
+    return task.result()
 
 
 @app.post(f"/{api_prefix}/v1/chat/completions" if api_prefix else "/v1/chat/completions")
 async def send_conversation(request: Request, req_token: str = Depends(oauth2_scheme)):
+    if not tokenizer_state["ready"]:
+        # get_encoding would otherwise block the event loop downloading the BPE files
+        try:
+            await asyncio.wait_for(asyncio.shield(app.state.tokenizer_warmup), timeout=10)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="Tokenizer is warming up", headers={"Retry-After": "10"})
     try:
-        request_data = await request.json()
+        request_data, request_body = await parse_request_body(request.stream())
     except Exception:
         raise HTTPException(status_code=400, detail={"error": "Invalid JSON body"})
-    chat_service, res = await async_retry(process, request_data, req_token)
+    try:
+        chat_service, res = await process_until_disconnect(request, request_data, req_token)
+    finally:
+        # attachments are uploaded before the response starts, retries included
+        request_body.close()
     try:
         if isinstance(res, types.AsyncGeneratorType):
             background = BackgroundTask(chat_service.close_client)
@@ -89,7 +142,7 @@ async def send_conversation(request: Request, req_token: str = Depends(oauth2_sc
         if e.status_code == 500:
             logger.error(f"Server error, {str(e)}")
             raise HTTPException(status_code=500, detail="Server error")
-        raise HTTPException(status_code=e.status_code, detail=e.detail)
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
     except Exception as e:
         await chat_service.close_client()
         logger.error(f"Server error, {str(e)}")
@@ -98,7 +151,7 @@ async def send_conversation(request: Request, req_token: str = Depends(oauth2_sc
 
 @app.get(f"/{api_prefix}/tokens" if api_prefix else "/tokens", response_class=HTMLResponse)
 async def upload_html(request: Request):
-    tokens_count = len(set(globals.token_list) - set(globals.error_token_list))
+    tokens_count = len(globals.token_pool.available)
     return templates.TemplateResponse("tokens.html",
                                       {"request": request, "api_prefix": api_prefix, "tokens_count": tokens_count})
 
@@ -106,44 +159,65 @@ async def upload_html(request: Request):
 @app.post(f"/{api_prefix}/tokens/upload" if api_prefix else "/tokens/upload")
 async def upload_post(text: str = Form(...)):
     lines = text.split("\n")
+    added = []
     for line in lines:
         if line.strip() and not line.startswith("#"):
-            globals.token_list.append(line.strip())
-            with open("data/token.txt", "a", encoding="utf-8") as f:
-                f.write(line.strip() + "\n")
-    logger.info(f"Token count: {len(globals.token_list)}, Error token count: {len(globals.error_token_list)}")
-    tokens_count = len(set(globals.token_list) - set(globals.error_token_list))
+            if globals.token_pool.add(line.strip()):
+                added.append(line.strip())
+                if scheduled_refresh:
+                    refresh_scheduler.add(line.strip())
+    if added:
+        await asyncio.to_thread(write_line_file, globals.TOKENS_FILE, added)
+    logger.info(f"Token count: {len(globals.token_pool)}, Error token count: {len(globals.token_pool.error_tokens)}")
+    tokens_count = len(globals.token_pool.available)
     return {"status": "success", "tokens_count": tokens_count}
 
 
 @app.post(f"/{api_prefix}/tokens/clear" if api_prefix else "/tokens/clear")
 async def upload_post():
-    globals.token_list.clear()
-    globals.error_token_list.clear()
-    with open("data/token.txt", "w", encoding="utf-8") as f:
-        pass
-    logger.info(f"Token count: {len(globals.token_list)}, Error token count: {len(globals.error_token_list)}")
-    tokens_count = len(set(globals.token_list) - set(globals.error_token_list))
+    globals.token_pool.clear()
+    await asyncio.to_thread(write_line_file, globals.TOKENS_FILE, [], "w")
+    await asyncio.to_thread(write_line_file, globals.ERROR_TOKENS_FILE, [], "w")
+    logger.info(f"Token count: {len(globals.token_pool)}, Error token count: {len(globals.token_pool.error_tokens)}")
+    tokens_count = len(globals.token_pool.available)
     return {"status": "success", "tokens_count": tokens_count}
 
 
 @app.post(f"/{api_prefix}/tokens/error" if api_prefix else "/tokens/error")
 async def error_tokens():
-    error_tokens_list = list(set(globals.error_token_list))
+    error_tokens_list = list(globals.token_pool.error_tokens)
     return {"status": "success", "error_tokens": error_tokens_list}
 
 
 @app.get(f"/{api_prefix}/tokens/add/{{token}}" if api_prefix else "/tokens/add/{token}")
 async def add_token(token: str):
     if token.strip() and not token.startswith("#"):
-        globals.token_list.append(token.strip())
-        with open("data/token.txt", "a", encoding="utf-8") as f:
-            f.write(token.strip() + "\n")
-    logger.info(f"Token count: {len(globals.token_list)}, Error token count: {len(globals.error_token_list)}")
-    tokens_count = len(set(globals.token_list) - set(globals.error_token_list))
+        if globals.token_pool.add(token.strip()):
+            await asyncio.to_thread(write_line_file, globals.TOKENS_FILE, [token.strip()])
+            if scheduled_refresh:
+                refresh_scheduler.add(token.strip())
+    logger.info(f"Token count: {len(globals.token_pool)}, Error token count: {len(globals.token_pool.error_tokens)}")
+    tokens_count = len(globals.token_pool.available)
     return {"status": "success", "tokens_count": tokens_count}
 
 
+@app.get(f"/{api_prefix}/ready" if api_prefix else "/ready")
+async def ready():
+    if not tokenizer_state["ready"]:
+        return JSONResponse({"status": "warming_up", "error": tokenizer_state["error"]}, status_code=503)
+    return {"status": "ready"}
+
+
+@app.get(f"/{api_prefix}/stats" if api_prefix else "/stats")
+async def stats():
+    return {"session_pool": session_pool.stats(), "pow_solver": pow_solver.stats(),
+            "requirements_pool": requirements_pool.stats(), "sentinel_prefetch": sentinel_prefetcher.stats(),
+            "token_pool": globals.token_pool.stats(), "token_capability": tokenCapability.stats(),
+            "state_store": globals.state_store.stats(), "refresh_scheduler": refresh_scheduler.stats(),
+            "token_count_cache": token_count_cache.stats(), "upload_cache": upload_cache.stats(),
+            "file_cache": file_cache.stats(), "image_resizer": image_resizer.stats()}
+
+
 if enable_gateway:
     @app.get("/", response_class=HTMLResponse)
     async def chatgpt_html(request: Request):
@@ -232,18 +306,6 @@ if enable_gateway:
     chatgpt_paths = ["c/"]
 
 
-@app.get("/")
-async def chatgpt(request: Request):
-    if not enable_gateway:
-        raise HTTPException(status_code=404, detail="Gateway is disabled")
-    req_token = get_req_token(authorization_list[0])
-    access_token = await verify_token(req_token)
-    response = templates.TemplateResponse("chatgpt.html", {"request": request, "access_token": access_token})
-    response.set_cookie("req_token", value=req_token)
-    response.set_cookie("access_token", value=access_token)
-    return response
-
-
     @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD", "PATCH", "TRACE"])
     async def reverse_proxy(request: Request, path: str):
         for chatgpt_path in chatgpt_paths:
@@ -266,9 +328,3 @@ else:
     @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD", "PATCH", "TRACE"])
     async def reverse_proxy():
         raise HTTPException(status_code=404, detail="Gateway is disabled")
-@app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD", "PATCH", "TRACE"])
-async def reverse_proxy(request: Request, path: str):
-    if path.startswith("c/"):
-        redirect_url = str(request.base_url)
-        return RedirectResponse(url=redirect_url, status_code=302)
-    return await chatgpt_reverse_proxy(request, path)
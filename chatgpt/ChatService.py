@@ -2,16 +2,29 @@ import asyncio
 import json
 import random
 import uuid
+from urllib.parse import quote
 
+import pybase64
 from fastapi import HTTPException
-from starlette.concurrency import run_in_threadpool
 
 from api.files import get_image_size, get_file_extension, determine_file_use_case
+from api.imageResize import image_resizer
 from api.models import model_proxy
+import chatgpt.globals as globals
 from chatgpt.authorization import get_req_token, verify_token, get_ua
-from chatgpt.chatFormat import api_messages_to_chat, stream_response, format_not_stream_response, head_process_response
-from chatgpt.chatLimit import check_is_limit, handle_request_limit
-from chatgpt.proofofWork import get_config, get_dpl, get_answer_token, get_requirements_token
+from chatgpt.chatFormat import (
+    api_messages_to_chat,
+    stream_response,
+    format_not_stream_response,
+    head_process_response,
+)
+from chatgpt.chatLimit import check_is_limit, handle_request_limit, limit_details, get_retry_after
+from chatgpt.proofofWork import get_dpl, pow_solver
+from chatgpt.requirementsPool import get_requirements
+from chatgpt.sentinelPrefetch import sentinel_prefetcher
+from chatgpt.streamParser import parse_events
+from chatgpt.uploadCache import upload_cache
+from chatgpt.tokenCapability import paid_models, record_persona, record_models, get_cached_models
 
 from utils.Client import Client
 from utils.Logger import logger
@@ -21,30 +34,56 @@ from utils.config import (
     ark0se_token_url_list,
     history_disabled,
     pow_difficulty,
+    pow_timeout,
     conversation_only,
     enable_limit,
     upload_by_url,
     check_model,
     auth_key,
     user_agents_list,
+    authorization_list,
     turnstile_solver_url,
+    stream_delta_encoding,
+    upload_block_size,
+    image_downscale,
 )
 
 
 class ChatService:
     def __init__(self, origin_token=None):
+        self.origin_token = origin_token
+        self.req_token = None
+        self.req_model = None
+        self.token_slot = None
+        self.chat_token = "gAAAAAB"
+        self.s = None
+        self.ws = None
+        self.response = None
+        self.prefetching = False
+        self.sentinel_bundle = None
+        self.chat_request = None
+        self.conversation_started = False
+
+    async def set_dynamic_data(self, data):
+        self.data = data
+        await self.set_model()
         # self.user_agent = random.choice(user_agents_list) if user_agents_list else "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36"
-        self.req_token = get_req_token(origin_token)
+        self.req_token = get_req_token(self.origin_token, model=self.req_model)
+        if self.req_token and not self.prefetching:
+            acquired = await globals.token_pool.acquire(self.req_token)
+            if not acquired and self.origin_token in authorization_list:
+                # the picked token stayed at its inflight cap, take whichever pooled token is least busy now
+                self.req_token = get_req_token(self.origin_token, model=self.req_model)
+                acquired = bool(self.req_token) and await globals.token_pool.acquire(self.req_token)
+            if not acquired:
+                raise HTTPException(status_code=429, detail="Too many concurrent requests for this token",
+                                    headers={"Retry-After": "1"})
+            self.token_slot = self.req_token
         self.ua = get_ua(self.req_token)
         self.user_agent = self.ua.get(
             "user-agent",
             "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36",
         )
-        self.chat_token = "gAAAAAB"
-        self.s = None
-        self.ws = None
-
-    async def set_dynamic_data(self, data):
         if self.req_token:
             logger.info(f"Request impersonate: {self.ua.get('impersonate')}")
             logger.info(f"Request ua:{self.user_agent}")
@@ -61,12 +100,12 @@ class ChatService:
             self.access_token = None
             self.account_id = None
 
-        self.data = data
-        await self.set_model()
         if enable_limit and self.req_token:
             limit_response = await handle_request_limit(self.req_token, self.req_model)
             if limit_response:
-                raise HTTPException(status_code=429, detail=limit_response)
+                clear_time = limit_details.get(self.req_token, {}).get(self.req_model)
+                headers = {"Retry-After": get_retry_after(clear_time)} if clear_time else None
+                raise HTTPException(status_code=429, detail=limit_response, headers=headers)
 
         self.account_id = self.data.get('Chatgpt-Account-Id', self.account_id)
         self.parent_message_id = self.data.get('parent_message_id')
@@ -79,13 +118,21 @@ class ChatService:
         if not isinstance(self.max_tokens, int):
             self.max_tokens = 2147483647
 
-        self.proxy_url = random.choice(proxy_url_list) if proxy_url_list else None
-        self.host_url = random.choice(chatgpt_base_url_list) if chatgpt_base_url_list else "https://chatgpt.com"
+        if not self.prefetching and not conversation_only:
+            self.sentinel_bundle = sentinel_prefetcher.take(self.req_token, self.origin_model)
+        if self.sentinel_bundle:
+            # sentinel tokens are only honoured for the device and route they were issued to
+            self.proxy_url = self.sentinel_bundle["proxy_url"]
+            self.host_url = self.sentinel_bundle["host_url"]
+            self.oai_device_id = self.sentinel_bundle["oai_device_id"]
+        else:
+            self.proxy_url = random.choice(proxy_url_list) if proxy_url_list else None
+            self.host_url = random.choice(chatgpt_base_url_list) if chatgpt_base_url_list else "https://chatgpt.com"
+            self.oai_device_id = str(uuid.uuid4())
         self.ark0se_token_url = random.choice(ark0se_token_url_list) if ark0se_token_url_list else None
 
         self.s = Client(proxy=self.proxy_url, impersonate=self.ua.get("impersonate", "safari15_3"))
 
-        self.oai_device_id = str(uuid.uuid4())
         self.persona = None
         self.ark0se_token = None
         self.proof_token = None
@@ -155,50 +202,87 @@ class ChatService:
         else:
             self.req_model = "auto"
 
+    def check_persona(self):
+        if self.persona != "chatgpt-paid":
+            if self.req_model in paid_models:
+                logger.error(f"Model {self.resp_model} not support for {self.persona}")
+                raise HTTPException(
+                    status_code=404,
+                    detail={
+                        "message": f"The model `{self.origin_model}` does not exist or you do not have access to it.",
+                        "type": "invalid_request_error",
+                        "param": None,
+                        "code": "model_not_found",
+                    },
+                )
+
+    def use_sentinel_bundle(self):
+        logger.info(f"Use prefetched sentinel tokens for {self.req_token[:40]}")
+        self.persona = self.sentinel_bundle["persona"]
+        if not check_model:
+            self.check_persona()
+        self.ark0se_token = self.sentinel_bundle["ark0se_token"]
+        self.turnstile_token = self.sentinel_bundle["turnstile_token"]
+        self.proof_token = self.sentinel_bundle["proof_token"]
+        self.chat_token = self.sentinel_bundle["chat_token"]
+        return self.chat_token
+
+    @staticmethod
+    async def prime_sentinel(req_token, origin_model):
+        chat_service = ChatService(req_token)
+        chat_service.prefetching = True
+        try:
+            await chat_service.set_dynamic_data({"model": origin_model})
+            await chat_service.get_chat_requirements()
+            return {
+                "chat_token": chat_service.chat_token,
+                "proof_token": chat_service.proof_token,
+                "turnstile_token": chat_service.turnstile_token,
+                "ark0se_token": chat_service.ark0se_token,
+                "persona": chat_service.persona,
+                "oai_device_id": chat_service.oai_device_id,
+                "host_url": chat_service.host_url,
+                "proxy_url": chat_service.proxy_url,
+            }
+        finally:
+            await chat_service.close_client()
+
     async def get_chat_requirements(self):
         if conversation_only:
             return None
+        if self.sentinel_bundle:
+            return self.use_sentinel_bundle()
         url = f'{self.base_url}/sentinel/chat-requirements'
         headers = self.base_headers.copy()
         try:
-            config = get_config(self.user_agent)
-            p = get_requirements_token(config)
+            config, p = await get_requirements(self.user_agent, self.host_url)
             data = {'p': p}
             r = await self.s.post(url, headers=headers, json=data, timeout=5)
             if r.status_code == 200:
                 resp = r.json()
+                self.persona = resp.get("persona")
+                record_persona(self.req_token, self.persona)
 
                 if check_model:
-                    r = await self.s.get(f'{self.base_url}/models', headers=headers, timeout=5)
-                    if r.status_code == 200:
-                        models = r.json().get('models')
-                        if not any(self.req_model in model.get("slug", "") for model in models):
-                            logger.error(f"Model {self.req_model} not support.")
-                            raise HTTPException(
-                                status_code=404,
-                                detail={
-                                    "message": f"The model `{self.origin_model}` does not exist or you do not have access to it.",
-                                    "type": "invalid_request_error",
-                                    "param": None,
-                                    "code": "model_not_found",
-                                },
-                            )
-                    else:
-                        raise HTTPException(status_code=404, detail="Failed to get models")
+                    models = get_cached_models(self.req_token)
+                    if models is None:
+                        r = await self.s.get(f'{self.base_url}/models', headers=headers, timeout=5)
+                        if r.status_code != 200:
+                            raise HTTPException(status_code=404, detail="Failed to get models")
+                        models = record_models(self.req_token, r.json().get('models'))
+                    if not any(self.req_model in slug for slug in models):
+                        logger.error(f"Model {self.req_model} not support.")
+                        raise HTTPException(
+                            status_code=404,
+                            detail={
+                                "message": f"The model `{self.origin_model}` does not exist or you do not have access to it.",
+                                "type": "invalid_request_error",
+                                "param": None,
+                                "code": "model_not_found",
+                            },
+                        )
                 else:
-                    self.persona = resp.get("persona")
-                    if self.persona != "chatgpt-paid":
-                        if self.req_model == "gpt-4":
-                            logger.error(f"Model {self.resp_model} not support for {self.persona}")
-                            raise HTTPException(
-                                status_code=404,
-                                detail={
-                                    "message": f"The model `{self.origin_model}` does not exist or you do not have access to it.",
-                                    "type": "invalid_request_error",
-                                    "param": None,
-                                    "code": "model_not_found",
-                                },
-                            )
+                    self.check_persona()
 
                 turnstile = resp.get('turnstile', {})
                 turnstile_required = turnstile.get('required')
@@ -247,8 +331,8 @@ class ChatService:
                     if proofofwork_diff <= pow_difficulty:
                         raise HTTPException(status_code=403, detail=f"Proof of work difficulty too high: {proofofwork_diff}")
                     proofofwork_seed = proofofwork.get("seed")
-                    self.proof_token, solved = await run_in_threadpool(
-                        get_answer_token, proofofwork_seed, proofofwork_diff, config
+                    self.proof_token, solved = await pow_solver.solve(
+                        proofofwork_seed, proofofwork_diff, config, timeout=pow_timeout
                     )
                     if not solved:
                         raise HTTPException(status_code=403, detail="Failed to solve proof of work")
@@ -325,6 +409,8 @@ class ChatService:
         }
         if self.conversation_id:
             self.chat_request['conversation_id'] = self.conversation_id
+        if stream_delta_encoding:
+            self.chat_request['supported_encodings'] = ["v1"]
         return self.chat_request
 
     async def send_conversation(self):
@@ -332,6 +418,7 @@ class ChatService:
             url = f'{self.base_url}/conversation'
             stream = self.data.get("stream", False)
             r = await self.s.post_stream(url, headers=self.chat_headers, json=self.chat_request, timeout=10, stream=True)
+            self.response = r
             if r.status_code != 200:
                 rtext = await r.atext()
                 if "application/json" == r.headers.get("Content-Type", ""):
@@ -351,17 +438,19 @@ class ChatService:
 
             content_type = r.headers.get("Content-Type", "")
             if "text/event-stream" in content_type:
-                res, start = await head_process_response(r.aiter_lines())
+                res, start = await head_process_response(parse_events(r.aiter_lines()))
                 if not start:
                     raise HTTPException(
                         status_code=403,
                         detail="Our systems have detected unusual activity coming from your system. Please try again later.",
                     )
+                self.conversation_started = True
                 if stream:
                     return stream_response(self, res, self.resp_model, self.max_tokens)
                 else:
                     return await format_not_stream_response(
-                        stream_response(self, res, self.resp_model, self.max_tokens),
+                        self,
+                        res,
                         self.prompt_tokens,
                         self.max_tokens,
                         self.resp_model,
@@ -440,7 +529,11 @@ class ChatService:
         )
         headers.pop('Authorization', None)
         try:
-            r = await self.s.put(upload_url, headers=headers, data=file_content, timeout=60)
+            if len(file_content) > upload_block_size << 20:
+                # no single-PUT fallback here, it would read the whole attachment into memory
+                r = await self.upload_blocks(upload_url, file_content, mime_type, headers)
+            else:
+                r = await self.s.put(upload_url, headers=headers, data=file_content.getvalue(), timeout=60)
             if r.status_code == 201:
                 return True
             else:
@@ -449,38 +542,74 @@ class ChatService:
             logger.error(f"Failed to upload file: {e}")
             return False
 
-    async def upload_file(self, file_content, mime_type):
+    async def upload_blocks(self, upload_url, file_content, mime_type, headers):
+        # Put Block / Put Block List, so only one block of a large attachment is held in memory at a time
+        separator = "&" if "?" in upload_url else "?"
+        headers = {key: value for key, value in headers.items() if key not in ('content-type', 'x-ms-blob-type')}
+        block_ids = []
+        async for block in file_content.blocks(upload_block_size << 20):
+            block_id = pybase64.b64encode(f"{len(block_ids):08d}".encode()).decode()
+            r = await self.s.put(f"{upload_url}{separator}comp=block&blockid={quote(block_id)}",
+                                 headers=headers, data=block, timeout=60)
+            if r.status_code != 201:
+                return r
+            block_ids.append(block_id)
+        block_list = "".join(f"<Latest>{block_id}</Latest>" for block_id in block_ids)
+        headers.update({'content-type': 'application/xml', 'x-ms-blob-content-type': mime_type})
+        return await self.s.put(f"{upload_url}{separator}comp=blocklist", headers=headers, timeout=60,
+                                data=f'<?xml version="1.0" encoding="utf-8"?><BlockList>{block_list}</BlockList>')
+
+    async def upload_file(self, file_content, mime_type, detail="auto"):
         if not file_content or not mime_type:
             return None
 
-        width, height = None, None
-        if mime_type.startswith("image/"):
-            try:
-                width, height = await get_image_size(file_content)
-            except Exception as e:
-                logger.error(f"Error image mime_type, change to text/plain: {e}")
-                mime_type = 'text/plain'
-        file_size = len(file_content)
-        file_extension = await get_file_extension(mime_type)
-        file_name = f"{uuid.uuid4()}{file_extension}"
-        use_case = await determine_file_use_case(mime_type)
-
-        file_id, upload_url = await self.get_upload_url(file_name, file_size, use_case)
-        if file_id and upload_url:
-            if await self.upload(upload_url, file_content, mime_type):
-                download_url = await self.get_download_url_from_upload(file_id)
-                if download_url:
-                    file_meta = {
-                        "file_id": file_id,
-                        "file_name": file_name,
-                        "size_bytes": file_size,
-                        "mime_type": mime_type,
-                        "width": width,
-                        "height": height,
-                        "use_case": use_case,
-                    }
-                    logger.info(f"File_meta: {file_meta}")
-                    return file_meta
+        account = (self.req_token, self.account_id)
+        digest = file_content.digest
+        cache_use_case = await determine_file_use_case(mime_type)
+        if image_downscale and mime_type.startswith("image/"):
+            # the uploaded bytes depend on the resolution the detail level needs
+            cache_use_case = (cache_use_case, "low" if detail == "low" else "auto")
+        file_meta = upload_cache.get(account, digest, cache_use_case)
+        if file_meta:
+            logger.info(f"File_meta from upload cache: {file_meta}")
+            return file_meta
+
+        resized = await image_resizer.resize(file_content, mime_type, detail) if image_downscale else None
+        try:
+            width, height = None, None
+            if resized:
+                file_content, (width, height) = resized
+            elif mime_type.startswith("image/"):
+                try:
+                    width, height = await get_image_size(file_content)
+                except Exception as e:
+                    logger.error(f"Error image mime_type, change to text/plain: {e}")
+                    mime_type = 'text/plain'
+            file_size = len(file_content)
+            file_extension = await get_file_extension(mime_type)
+            file_name = f"{uuid.uuid4()}{file_extension}"
+            use_case = await determine_file_use_case(mime_type)
+
+            file_id, upload_url = await self.get_upload_url(file_name, file_size, use_case)
+            if file_id and upload_url:
+                if await self.upload(upload_url, file_content, mime_type):
+                    download_url = await self.get_download_url_from_upload(file_id)
+                    if download_url:
+                        file_meta = {
+                            "file_id": file_id,
+                            "file_name": file_name,
+                            "size_bytes": file_size,
+                            "mime_type": mime_type,
+                            "width": width,
+                            "height": height,
+                            "use_case": use_case,
+                        }
+                        logger.info(f"File_meta: {file_meta}")
+                        upload_cache.put(account, digest, cache_use_case, file_meta)
+                        return file_meta
+        finally:
+            if resized:
+                resized[0].close()
 
     async def check_upload(self, file_id):
         url = f'{self.base_url}/files/{file_id}'
@@ -512,7 +641,21 @@ class ChatService:
             logger.info("Failed to get response file url")
             return None
 
+    async def close_response(self):
+        if self.response:
+            await Client.close_stream(self.response)
+            self.response = None
+        if self.token_slot:
+            globals.token_pool.release(self.token_slot)
+            self.token_slot = None
+
     async def close_client(self):
+        # only a conversation that went through proves the token and model are worth priming for
+        if self.conversation_started and not self.prefetching:
+            sentinel_prefetcher.schedule(self.req_token, self.origin_model, self.prime_sentinel)
+        if self.token_slot:
+            globals.token_pool.release(self.token_slot)
+            self.token_slot = None
         if self.s:
             await self.s.close()
         if self.ws:
@@ -1,13 +1,14 @@
-import asyncio
-import json
 import os
 import random
+from datetime import datetime
 
 import ua_generator
 from fastapi import HTTPException
 
 import chatgpt.globals as globals
+from chatgpt.chatLimit import expire_limits, earliest_clear_time, get_retry_after
 from chatgpt.refreshToken import rt2ac
+from chatgpt.tokenCapability import expire_models
 from utils.Logger import logger
 from utils.config import authorization_list, random_token
 
@@ -15,26 +16,32 @@ os.environ['PYTHONHASHSEED'] = '0'
 random.seed(0)
 
 
-def get_req_token(req_token, seed=None):
-    available_token_list = list(set(globals.token_list) - set(globals.error_token_list))
-    length = len(available_token_list)
-    if seed and length > 0:
-        req_token = globals.token_list[hash(seed) % length]
-        while req_token in globals.error_token_list:
-            req_token = random.choice(globals.token_list)
-        return req_token
+def get_req_token(req_token, seed=None, model=None):
+    if seed:
+        return globals.token_pool.seeded_token(seed)
 
     if req_token in authorization_list:
-        if len(available_token_list) > 0:
-            if random_token:
-                req_token = random.choice(available_token_list)
-                return req_token
-            else:
-                globals.count += 1
-                globals.count %= length
-                return available_token_list[globals.count]
-        else:
-            return None
+        expire_limits()
+        expire_models()
+        token = globals.token_pool.least_loaded_token(model, randomly=random_token)
+        if not token and model and globals.token_pool.available:
+            clear_time = earliest_clear_time(model)
+            if not clear_time:
+                logger.error(f"No token can serve {model}")
+                raise HTTPException(
+                    status_code=404,
+                    detail={
+                        "message": f"The model `{model}` does not exist or you do not have access to it.",
+                        "type": "invalid_request_error",
+                        "param": None,
+                        "code": "model_not_found",
+                    },
+                )
+            detail = (f"Request limit exceeded. All tokens reached the {model} limit, "
+                      f"try again after {datetime.fromtimestamp(clear_time).replace(microsecond=0)}")
+            logger.info(detail)
+            raise HTTPException(status_code=429, detail=detail, headers={"Retry-After": get_retry_after(clear_time)})
+        return token
     else:
         return req_token
 
@@ -62,8 +69,7 @@ def get_ua(req_token):
                 "impersonate": random.choice(globals.impersonate_list),
             }
             globals.user_agent_map[req_token] = user_agent
-            with open(globals.USER_AGENTS_FILE, "w", encoding="utf-8") as f:
-                f.write(json.dumps(globals.user_agent_map, indent=4))
+            globals.state_store.set("user_agents", req_token, user_agent)
             return user_agent
     else:
         return user_agent
@@ -89,13 +95,3 @@ async def verify_token(req_token):
         else:
             return req_token
 
-
-async def refresh_all_tokens(force_refresh=False):
-    for token in list(set(globals.token_list) - set(globals.error_token_list)):
-        if len(token) == 45:
-            try:
-                await asyncio.sleep(2)
-                await rt2ac(token, force_refresh=force_refresh)
-            except HTTPException:
-                pass
-    logger.info("All tokens refreshed.")
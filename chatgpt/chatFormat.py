@@ -5,6 +5,7 @@ import re
 import string
 import time
 import uuid
+from collections import namedtuple
 
 import pybase64
 import websockets
@@ -12,42 +13,35 @@ from fastapi import HTTPException
 
 from api.files import get_file_content
 from api.models import model_system_fingerprint
-from api.tokens import split_tokens_from_content, calculate_image_tokens, num_tokens_from_messages
+from api.tokens import CompletionTokenCounter, calculate_image_tokens, num_tokens_from_messages
+from chatgpt.sseEncoder import SSEEncoder
+from chatgpt.streamParser import DONE
 from utils.Logger import logger
+from utils.config import upload_concurrency
+
+ChatDelta = namedtuple("ChatDelta", ["delta", "finish_reason", "message_id", "conversation_id"])
 
 moderation_message = "I'm sorry, I cannot provide or engage in any content related to pornography, violence, or any unethical material. If you have any other questions or need assistance, please feel free to let me know. I'll do my best to provide support and assistance."
 
 
-async def format_not_stream_response(response, prompt_tokens, max_tokens, model):
+async def format_not_stream_response(service, response, prompt_tokens, max_tokens, model):
     chat_id = f"chatcmpl-{''.join(random.choice(string.ascii_letters + string.digits) for _ in range(29))}"
     system_fingerprint_list = model_system_fingerprint.get(model, None)
     system_fingerprint = random.choice(system_fingerprint_list) if system_fingerprint_list else None
     created_time = int(time.time())
-    all_text = ""
-    async for chunk in response:
-        try:
-            if chunk.startswith("data: [DONE]"):
-                break
-            elif not chunk.startswith("data: "):
-                continue
-            else:
-                chunk = json.loads(chunk[6:])
-                if not chunk["choices"][0].get("delta"):
-                    continue
-                all_text += chunk["choices"][0]["delta"]["content"]
-        except Exception as e:
-            logger.error(f"Error: {chunk}, error: {str(e)}")
-            continue
-    content, completion_tokens, finish_reason = await split_tokens_from_content(all_text, max_tokens, model)
+    counter = CompletionTokenCounter(model, max_tokens)
+    texts = []
+    async for event in translate_response(service, response, counter):
+        if event is DONE:
+            break
+        if event.delta.get("content"):
+            texts.append(event.delta["content"])
     message = {
         "role": "assistant",
-        "content": content,
-    }
-    usage = {
-        "prompt_tokens": prompt_tokens,
-        "completion_tokens": completion_tokens,
-        "total_tokens": prompt_tokens + completion_tokens
+        "content": "".join(texts),
     }
+    finish_reason = "length" if counter.reached else "stop"
+    usage = get_usage(prompt_tokens, counter.tokens)
     if not message.get("content"):
         raise HTTPException(status_code=403, detail="No content in the message.")
 
@@ -109,10 +103,8 @@ async def wss_stream_response(websocket, conversation_id):
 
 
 async def head_process_response(response):
-    async for chunk in response:
-        chunk = chunk.decode("utf-8")
-        if chunk.startswith("data: {"):
-            chunk_old_data = json.loads(chunk[6:])
+    async for chunk_old_data in response:
+        if isinstance(chunk_old_data, dict):
             message = chunk_old_data.get("message", {})
             if not message and "error" in chunk_old_data:
                 return response, False
@@ -126,12 +118,36 @@ async def head_process_response(response):
     return response, False
 
 
+def get_usage(prompt_tokens, completion_tokens):
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+
+
 async def stream_response(service, response, model, max_tokens):
     chat_id = f"chatcmpl-{''.join(random.choice(string.ascii_letters + string.digits) for _ in range(29))}"
     system_fingerprint_list = model_system_fingerprint.get(model, None)
     system_fingerprint = random.choice(system_fingerprint_list) if system_fingerprint_list else None
     created_time = int(time.time())
-    completion_tokens = 0
+    counter = CompletionTokenCounter(model, max_tokens)
+    include_usage = (service.data.get("stream_options") or {}).get("include_usage")
+    encoder = SSEEncoder(chat_id, created_time, model, system_fingerprint)
+    yield encoder.encode({"role": "assistant", "content": ""})
+
+    async for event in translate_response(service, response, counter):
+        if event is DONE:
+            if include_usage:
+                include_usage = False
+                yield encoder.encode_usage(get_usage(service.prompt_tokens, counter.tokens))
+            yield "data: [DONE]\n\n"
+            continue
+        ids = None if service.history_disabled else (event.message_id, event.conversation_id)
+        yield encoder.encode(event.delta, event.finish_reason, ids)
+
+
+async def translate_response(service, response, counter):
     len_last_content = 0
     len_last_citation = 0
     last_message_id = None
@@ -140,33 +156,13 @@ async def stream_response(service, response, model, max_tokens):
     model_slug = None
     end = False
 
-    chunk_new_data = {
-        "id": chat_id,
-        "object": "chat.completion.chunk",
-        "created": created_time,
-        "model": model,
-        "choices": [
-            {
-                "index": 0,
-                "delta": {"role": "assistant", "content": ""},
-                "logprobs": None,
-                "finish_reason": None
-            }
-        ]
-    }
-    if system_fingerprint:
-        chunk_new_data["system_fingerprint"] = system_fingerprint
-    yield f"data: {json.dumps(chunk_new_data)}\n\n"
-
-    async for chunk in response:
-        chunk = chunk.decode("utf-8")
+    async for chunk_old_data in response:
         if end:
             logger.info(f"Response Model: {model_slug}")
-            yield "data: [DONE]\n\n"
+            yield DONE
             break
         try:
-            if chunk.startswith("data: {"):
-                chunk_old_data = json.loads(chunk[6:])
+            if isinstance(chunk_old_data, dict):
                 finish_reason = None
                 message = chunk_old_data.get("message", {})
                 conversation_id = chunk_old_data.get("conversation_id")
@@ -244,10 +240,6 @@ async def stream_response(service, response, model, max_tokens):
 
                     delta = {"content": new_text}
                     last_content_type = outer_content_type
-                    if completion_tokens >= max_tokens:
-                        delta = {}
-                        finish_reason = "length"
-                        end = True
                 elif status == "finished_successfully":
                     if content.get("content_type") == "multimodal_text":
                         parts = content.get("parts", [])
@@ -270,7 +262,7 @@ async def stream_response(service, response, model, max_tokens):
                         part = content.get("parts", [])[0]
                         new_text = part[len_last_content:]
                         if not new_text:
-                            matches = re.findall(r'\(sandbox:(.*?)\)', part)
+                            matches = re.findall(r'\(sandbox:(.*?)\)', str(part))
                             if matches:
                                 file_url_content = ""
                                 for i, sandbox_path in enumerate(matches):
@@ -294,30 +286,33 @@ async def stream_response(service, response, model, max_tokens):
                     continue
                 last_message_id = message_id
                 last_role = role
+                if delta.get("content"):
+                    delta["content"] = counter.feed(delta["content"])
+                    if counter.reached:
+                        # stop the upstream generating past max_tokens, the account is free again right away
+                        await service.close_response()
+                        finish_reason = "length"
+                        end = True
+                        if not delta["content"]:
+                            delta = {}
                 if not end and not delta.get("content"):
                     delta = {"role": "assistant", "content": ""}
-                chunk_new_data["choices"][0]["delta"] = delta
-                chunk_new_data["choices"][0]["finish_reason"] = finish_reason
-                if not service.history_disabled:
-                    chunk_new_data.update({
-                        "message_id": message_id,
-                        "conversation_id": conversation_id,
-                    })
-                completion_tokens += 1
-                yield f"data: {json.dumps(chunk_new_data)}\n\n"
-            elif chunk.startswith("data: [DONE]"):
+                yield ChatDelta(delta, finish_reason, message_id, conversation_id)
+                if counter.reached:
+                    logger.info(f"Response Model: {model_slug}")
+                    yield DONE
+                    break
+            elif chunk_old_data == DONE:
                 logger.info(f"Response Model: {model_slug}")
-                yield "data: [DONE]\n\n"
+                yield DONE
             else:
                 continue
         except Exception as e:
-            if chunk.startswith("data: "):
-                chunk_data = json.loads(chunk[6:])
-                if chunk_data.get("error"):
-                    logger.error(f"Error: {chunk_data.get('error')}")
-                    yield "data: [DONE]\n\n"
-                    break
-            logger.error(f"Error: {chunk}, details: {str(e)}")
+            if isinstance(chunk_old_data, dict) and chunk_old_data.get("error"):
+                logger.error(f"Error: {chunk_old_data.get('error')}")
+                yield DONE
+                break
+            logger.error(f"Error: {chunk_old_data}, details: {str(e)}")
             continue
 
 
@@ -361,15 +356,89 @@ def format_messages_with_url(content):
     return new_content
 
 
+async def upload_attachment(service, image_url, semaphore):
+    url = image_url.get("url")
+    detail = image_url.get("detail", "auto")
+    async with semaphore:
+        started = time.perf_counter()
+        file_content, mime_type = await get_file_content(url)
+        fetched = time.perf_counter()
+        try:
+            file_meta = await service.upload_file(file_content, mime_type, detail)
+        finally:
+            if file_content is not None:
+                file_content.close()
+        uploaded = time.perf_counter()
+        if not file_meta:
+            return None, None, 0
+        file_id = file_meta["file_id"]
+        file_size = file_meta["size_bytes"]
+        file_name = file_meta["file_name"]
+        mime_type = file_meta["mime_type"]
+        use_case = file_meta["use_case"]
+        if mime_type.startswith("image/"):
+            width, height = file_meta["width"], file_meta["height"]
+            file_tokens = await calculate_image_tokens(width, height, detail)
+            part = {
+                "content_type": "image_asset_pointer",
+                "asset_pointer": f"file-service://{file_id}",
+                "size_bytes": file_size,
+                "width": width,
+                "height": height
+            }
+            attachment = {
+                "id": file_id,
+                "size": file_size,
+                "name": file_name,
+                "mime_type": mime_type,
+                "width": width,
+                "height": height
+            }
+        else:
+            if not use_case == "ace_upload" and not file_meta.get("cached"):
+                await service.check_upload(file_id)
+            file_tokens = file_size // 1000
+            part = None
+            attachment = {
+                "id": file_id,
+                "size": file_size,
+                "name": file_name,
+                "mime_type": mime_type,
+            }
+        indexed = time.perf_counter()
+        logger.info(f"Attachment {file_id}: {file_size} bytes, fetch {(fetched - started) * 1000:.0f}ms, "
+                    f"upload {(uploaded - fetched) * 1000:.0f}ms, index {(indexed - uploaded) * 1000:.0f}ms")
+        return part, attachment, file_tokens
+
+
+async def upload_attachments(service, image_urls):
+    semaphore = asyncio.Semaphore(upload_concurrency)
+    tasks = [asyncio.create_task(upload_attachment(service, image_url, semaphore)) for image_url in image_urls]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
 async def api_messages_to_chat(service, api_messages, upload_by_url=False):
     file_tokens = 0
     chat_messages = []
+    contents = []
+    image_urls = []
     for api_message in api_messages:
-        role = api_message.get('role')
         content = api_message.get('content')
         if upload_by_url:
             if isinstance(content, str):
                 content = format_messages_with_url(content)
+        if isinstance(content, list):
+            image_urls += [i.get("image_url") for i in content if i.get("type") == "image_url"]
+        contents.append(content)
+    # every attachment of the request is fetched and uploaded concurrently, results are placed back in order
+    uploads = iter(await upload_attachments(service, image_urls)) if image_urls else iter(())
+    for api_message, content in zip(api_messages, contents):
+        role = api_message.get('role')
         if isinstance(content, list):
             parts = []
             attachments = []
@@ -378,45 +447,12 @@ async def api_messages_to_chat(service, api_messages, upload_by_url=False):
                 if i.get("type") == "text":
                     parts.append(i.get("text"))
                 elif i.get("type") == "image_url":
-                    image_url = i.get("image_url")
-                    url = image_url.get("url")
-                    detail = image_url.get("detail", "auto")
-                    file_content, mime_type = await get_file_content(url)
-                    file_meta = await service.upload_file(file_content, mime_type)
-                    if file_meta:
-                        file_id = file_meta["file_id"]
-                        file_size = file_meta["size_bytes"]
-                        file_name = file_meta["file_name"]
-                        mime_type = file_meta["mime_type"]
-                        use_case = file_meta["use_case"]
-                        if mime_type.startswith("image/"):
-                            width, height = file_meta["width"], file_meta["height"]
-                            file_tokens += await calculate_image_tokens(width, height, detail)
-                            parts.append({
-                                "content_type": "image_asset_pointer",
-                                "asset_pointer": f"file-service://{file_id}",
-                                "size_bytes": file_size,
-                                "width": width,
-                                "height": height
-                            })
-                            attachments.append({
-                                "id": file_id,
-                                "size": file_size,
-                                "name": file_name,
-                                "mime_type": mime_type,
-                                "width": width,
-                                "height": height
-                            })
-                        else:
-                            if not use_case == "ace_upload":
-                                await service.check_upload(file_id)
-                            file_tokens += file_size // 1000
-                            attachments.append({
-                                "id": file_id,
-                                "size": file_size,
-                                "name": file_name,
-                                "mime_type": mime_type,
-                            })
+                    part, attachment, tokens = next(uploads)
+                    if part:
+                        parts.append(part)
+                    if attachment:
+                        attachments.append(attachment)
+                    file_tokens += tokens
             metadata = {
                 "attachments": attachments
             }
@@ -1,19 +1,56 @@
-import threading
+import heapq
 import time
 from datetime import datetime
 
+import chatgpt.globals as globals
 from utils.Logger import logger
+from utils.config import enable_limit
 
 limit_details = {}
+limit_heap = []
 
 
 def check_is_limit(detail, token, model):
     if token and isinstance(detail, dict) and detail.get('clears_in'):
         clear_time = int(time.time()) + detail.get('clears_in')
         limit_details.setdefault(token, {})[model] = clear_time
+        heapq.heappush(limit_heap, (clear_time, token, model))
+        globals.token_pool.refresh(token)
         logger.info(f"{token[:40]}: Reached {model} limit, will be cleared at {datetime.fromtimestamp(clear_time).replace(microsecond=0)}")
 
 
+def is_limited(token, model):
+    clear_time = limit_details.get(token, {}).get(model)
+    return clear_time is not None and clear_time > int(time.time())
+
+
+def expire_limits():
+    now = int(time.time())
+    while limit_heap and limit_heap[0][0] <= now:
+        clear_time, token, model = heapq.heappop(limit_heap)
+        if limit_details.get(token, {}).get(model) == clear_time:
+            clear_limit(token, model)
+
+
+def clear_limit(token, model):
+    models = limit_details.get(token)
+    if models and model in models:
+        del models[model]
+        if not models:
+            del limit_details[token]
+        globals.token_pool.refresh(token)
+
+
+def earliest_clear_time(model):
+    clear_times = [models[model] for token, models in limit_details.items()
+                   if model in models and globals.token_pool.is_available(token)]
+    return min(clear_times) if clear_times else None
+
+
+def get_retry_after(clear_time):
+    return str(max(clear_time - int(time.time()), 1))
+
+
 async def handle_request_limit(token, model):
     try:
         if limit_details.get(token) and model in limit_details[token]:
@@ -25,7 +62,7 @@ async def handle_request_limit(token, model):
                 logger.info(result)
                 return result
             else:
-                del limit_details[token][model]
+                clear_limit(token, model)
                 return None
     except KeyError as e:
         logger.error(f"Key error: {e}")
@@ -33,3 +70,7 @@ async def handle_request_limit(token, model):
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}")
         return None
+
+
+if enable_limit:
+    globals.token_pool.add_filter(lambda token, model: not is_limited(token, model))
@@ -1,10 +1,12 @@
-import json
 import os
 
 import ua_generator
 import random
 
+from chatgpt.stateStore import StateStore, import_legacy_files, read_line_file
+from chatgpt.tokenPool import TokenPool
 from utils.Logger import logger
+from utils.config import token_max_inflight, token_acquire_timeout
 
 DATA_FOLDER = "data"
 TOKENS_FILE = os.path.join(DATA_FOLDER, "token.txt")
@@ -12,10 +14,9 @@ REFRESH_MAP_FILE = os.path.join(DATA_FOLDER, "refresh_map.json")
 ERROR_TOKENS_FILE = os.path.join(DATA_FOLDER, "error_token.txt")
 WSS_MAP_FILE = os.path.join(DATA_FOLDER, "wss_map.json")
 USER_AGENTS_FILE = os.path.join(DATA_FOLDER, "user_agents.json")
+STATE_DB_FILE = os.path.join(DATA_FOLDER, "state.db")
 
-count = 0
-token_list = []
-error_token_list = []
+token_pool = TokenPool(max_inflight=token_max_inflight, acquire_timeout=token_acquire_timeout)
 refresh_map = {}
 wss_map = {}
 user_agent_map = {}
@@ -37,72 +38,37 @@ impersonate_list = [
 if not os.path.exists(DATA_FOLDER):
     os.makedirs(DATA_FOLDER)
 
-if os.path.exists(REFRESH_MAP_FILE):
-    with open(REFRESH_MAP_FILE, "r") as file:
-        refresh_map = json.load(file)
-else:
-    refresh_map = {}
+state_store = StateStore(STATE_DB_FILE)
+if state_store.created:
+    import_legacy_files(state_store, {
+        "refresh_map": REFRESH_MAP_FILE,
+        "wss_map": WSS_MAP_FILE,
+        "user_agents": USER_AGENTS_FILE,
+    })
 
-if os.path.exists(WSS_MAP_FILE):
-    with open(WSS_MAP_FILE, "r") as file:
-        wss_map = json.load(file)
-else:
-    wss_map = {}
+# token.txt 和 error_token.txt 可手动编辑，启动时直接读取，不进状态库
+for token in read_line_file(TOKENS_FILE):
+    token_pool.add(token)
 
+for token in read_line_file(ERROR_TOKENS_FILE):
+    token_pool.mark_error(token)
 
-if os.path.exists(TOKENS_FILE):
-    with open(TOKENS_FILE, "r", encoding="utf-8") as f:
-        for line in f:
-            if line.strip() and not line.startswith("#"):
-                token_list.append(line.strip())
-else:
-    with open(TOKENS_FILE, "w", encoding="utf-8") as f:
-        pass
+refresh_map = dict(state_store.items("refresh_map"))
+wss_map = dict(state_store.items("wss_map"))
+user_agent_map = dict(state_store.items("user_agents"))
 
-
-if os.path.exists(ERROR_TOKENS_FILE):
-    with open(ERROR_TOKENS_FILE, "r", encoding="utf-8") as f:
-        for line in f:
-            if line.strip() and not line.startswith("#"):
-                error_token_list.append(line.strip())
-else:
-    with open(ERROR_TOKENS_FILE, "w", encoding="utf-8") as f:
-        pass
-
-if os.path.exists(USER_AGENTS_FILE):
-    with open(USER_AGENTS_FILE, "r", encoding="utf-8") as f:
-        try:
-            user_agent_map = json.load(f)
-        except json.JSONDecodeError:
-            user_agent_map = {}
-    # token数量变化时，更新ua
-    if len(user_agent_map.keys()) != len(token_list):
-        new_tokens = list(set(token_list) - user_agent_map.keys())
-        for token in new_tokens:
-            ua = ua_generator.generate(device='desktop', browser=('chrome', 'edge'), platform=('windows', 'macos'))
-            ua_dict = {
-                "user-agent": ua.text,
-                "sec-ch-ua-platform": ua.platform,
-                "sec-ch-ua": ua.ch.brands,
-                "sec-ch-ua-mobile": ua.ch.mobile,
-                "impersonate": random.choice(impersonate_list),
-            }
-            user_agent_map[token] = ua_dict
-        with open(USER_AGENTS_FILE, "w", encoding="utf-8") as f:
-            f.write(json.dumps(user_agent_map, indent=4))
-else:
-    for token in token_list:
+# token数量变化时，更新ua
+for token in token_pool.tokens:
+    if token not in user_agent_map:
         ua = ua_generator.generate(device='desktop', browser=('chrome', 'edge'), platform=('windows', 'macos'))
-        ua_dict = {
+        user_agent_map[token] = {
             "user-agent": ua.text,
             "sec-ch-ua-platform": ua.platform,
             "sec-ch-ua": ua.ch.brands,
             "sec-ch-ua-mobile": ua.ch.mobile,
             "impersonate": random.choice(impersonate_list),
         }
-        user_agent_map[token] = ua_dict
-    with open(USER_AGENTS_FILE, "w", encoding="utf-8") as f:
-        f.write(json.dumps(user_agent_map, indent=4))
+        state_store.set("user_agents", token, user_agent_map[token])
 
-if token_list:
-    logger.info(f"Token list count: {len(token_list)}, Error token list count: {len(error_token_list)}")
+if token_pool.tokens:
+    logger.info(f"Token list count: {len(token_pool)}, Error token list count: {len(token_pool.error_tokens)}")
@@ -0,0 +1,186 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pybase64
+
+from utils.Logger import logger
+
+
+def solve_range(seed, diff, config, start, stop, stop_event=None, check_every=4096):
+    static_config_part1 = (json.dumps(config[:3], separators=(',', ':'), ensure_ascii=False)[:-1] + ',').encode()
+    static_config_part2 = (',' + json.dumps(config[4:9], separators=(',', ':'), ensure_ascii=False)[1:-1] + ',').encode()
+    static_config_part3 = (',' + json.dumps(config[10:], separators=(',', ':'), ensure_ascii=False)[1:]).encode()
+
+    # hash_value[:len(diff)] <= target_diff compares more bytes than the target has,
+    # which is the same as comparing the whole digest strictly below the target
+    target_diff = bytes.fromhex(diff)
+
+    # base64 of the 3-byte aligned static prefix never changes, so it is encoded once
+    # and absorbed into the sha3 state; only the variable tail is encoded per nonce
+    aligned = len(static_config_part1) - len(static_config_part1) % 3
+    prefix_encode = pybase64.b64encode(static_config_part1[:aligned])
+    prefix_hash = hashlib.sha3_512(seed.encode() + prefix_encode)
+    tail_format = b"%d".join([
+        static_config_part1[aligned:].replace(b"%", b"%%"),
+        static_config_part2.replace(b"%", b"%%"),
+        static_config_part3.replace(b"%", b"%%"),
+    ])
+
+    b64encode = pybase64.b64encode
+    copy = prefix_hash.copy
+    # a thread cannot be killed, so a solve running in one polls stop_event between blocks of nonces
+    for block_start in range(start, stop, check_every):
+        if stop_event is not None and stop_event.is_set():
+            return None
+        for i in range(block_start, min(block_start + check_every, stop)):
+            tail_encode = b64encode(tail_format % (i, i >> 1))
+            hash_value = copy()
+            hash_value.update(tail_encode)
+            if hash_value.digest() < target_diff:
+                return (prefix_encode + tail_encode).decode()
+    return None
+
+
+class PowSolver:
+    def __init__(self, workers=1, chunk_size=20000, max_attempts=500000):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.max_attempts = max_attempts
+        self.executor = None
+        self.solves = 0
+        self.solved = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.total_time = 0.0
+        self.last_time = 0.0
+
+    def get_executor(self):
+        if self.executor is None:
+            # spawn keeps the workers free of the event loop and curl handles of the parent
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context("spawn"))
+        return self.executor
+
+    async def solve(self, seed, diff, config, timeout=None):
+        start = time.perf_counter()
+        self.solves += 1
+        stop_event = threading.Event()
+        try:
+            if self.workers > 1:
+                answer = await self.solve_sharded(seed, diff, config, timeout)
+            else:
+                answer = await asyncio.wait_for(
+                    asyncio.to_thread(solve_range, seed, diff, config, 0, self.max_attempts, stop_event), timeout
+                )
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            answer = None
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            logger.info(f"diff: {diff}, cancelled after {int((time.perf_counter() - start) * 1e6) / 1e3}ms")
+            raise
+        finally:
+            stop_event.set()
+            self.last_time = time.perf_counter() - start
+            self.total_time += self.last_time
+        solved = answer is not None
+        if solved:
+            self.solved += 1
+        else:
+            answer = "wQ8Lk5FbGpA2NcR9dShT6gYjU7VxZ4D" + pybase64.b64encode(f'"{seed}"'.encode()).decode()
+        logger.info(f'diff: {diff}, time: {int(self.last_time * 1e6) / 1e3}ms, solved: {solved}, workers: {self.workers}')
+        return "gAAAAAB" + answer, solved
+
+    async def solve_sharded(self, seed, diff, config, timeout=None):
+        loop = asyncio.get_running_loop()
+        executor = self.get_executor()
+        deadline = loop.time() + timeout if timeout else None
+        next_start = 0
+        pending = set()
+
+        def submit():
+            nonlocal next_start
+            stop = min(next_start + self.chunk_size, self.max_attempts)
+            pending.add(loop.run_in_executor(executor, solve_range, seed, diff, config, next_start, stop))
+            next_start = stop
+
+        try:
+            while next_start < self.max_attempts and len(pending) < self.workers:
+                submit()
+            while pending:
+                remaining = deadline - loop.time() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    raise asyncio.TimeoutError
+                done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    answer = future.result()
+                    if answer:
+                        return answer
+                while next_start < self.max_attempts and len(pending) < self.workers:
+                    submit()
+            return None
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def warmup(self):
+        if self.workers > 1:
+            self.get_executor().submit(solve_range, "", "ff", [], 0, 0)
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "solves": self.solves,
+            "solved": self.solved,
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+            "avg_ms": int(self.total_time / self.solves * 1e6) / 1e3 if self.solves else 0,
+            "last_ms": int(self.last_time * 1e6) / 1e3,
+        }
+
+
+if __name__ == "__main__":
+    import random
+
+    def solve_range_legacy(seed, diff, config, start, stop):
+        diff_len = len(diff)
+        seed_encoded = seed.encode()
+        part1 = (json.dumps(config[:3], separators=(',', ':'), ensure_ascii=False)[:-1] + ',').encode()
+        part2 = (',' + json.dumps(config[4:9], separators=(',', ':'), ensure_ascii=False)[1:-1] + ',').encode()
+        part3 = (',' + json.dumps(config[10:], separators=(',', ':'), ensure_ascii=False)[1:]).encode()
+        target_diff = bytes.fromhex(diff)
+        for i in range(start, stop):
+            final_json_bytes = part1 + str(i).encode() + part2 + str(i >> 1).encode() + part3
+            base_encode = pybase64.b64encode(final_json_bytes)
+            hash_value = hashlib.sha3_512(seed_encoded + base_encode).digest()
+            if hash_value[:diff_len] <= target_diff:
+                return base_encode.decode()
+        return None
+
+    config = [
+        4016, "Mon Oct 14 2024 10:00:00 GMT-0500 (Eastern Standard Time)", 4294705152, 0,
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36",
+        "https://cdn.oaistatic.com/_next/static/chunks/main-app.js?dpl=453ebaec0d44c2decab71692e1bfe39be35a24b3",
+        "dpl=453ebaec0d44c2decab71692e1bfe39be35a24b3", "en-US", "en-US,es-US,en,es", 0,
+        "webdriver\u2212false", "location", "ondragend", 1234.5, "b6a1c5a9-8f2d-4c4e-9b7e-1f0e2d3c4b5a",
+    ]
+    for _ in range(200):
+        seed, diff = format(random.random()), random.choice(["0fffff", "00ffff", "000fff"])
+        assert solve_range(seed, diff, config, 0, 500000) == solve_range_legacy(seed, diff, config, 0, 500000)
+
+    attempts = 200000
+    for name, kernel in (("legacy", solve_range_legacy), ("midstate", solve_range)):
+        start = time.perf_counter()
+        kernel("0.42", "00000000", config, 0, attempts)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>8}: {attempts / elapsed:,.0f} hashes/s")
@@ -1,5 +1,4 @@
-import hashlib
-import json
+import asyncio
 import random
 import re
 import time
@@ -9,18 +8,21 @@ from html.parser import HTMLParser
 
 import pybase64
 
+from chatgpt.powSolver import PowSolver, solve_range
+from utils.Client import Client
 from utils.Logger import logger
-from utils.config import conversation_only
+from utils.config import conversation_only, pow_workers, chatgpt_base_url_list, proxy_url_list
 
 cores = [16, 24, 32]
 screens = [3000, 4000, 6000]
 timeLayout = "%a %b %d %Y %H:%M:%S"
 
-cached_scripts = []
-cached_dpl = ""
-cached_time = 0
+dpl_cache = {}
+dpl_tasks = {}
 cached_require_proof = ""
 
+pow_solver = PowSolver(workers=pow_workers)
+
 navigator_key = [
     "registerProtocolHandler−function registerProtocolHandler() { [native code] }",
     "storage−[object StorageManager]",
@@ -381,56 +383,87 @@ window_key = [
 
 
 class ScriptSrcParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.scripts = []
+        self.dpl = ""
+
     def handle_starttag(self, tag, attrs):
-        global cached_scripts, cached_dpl, cached_time
         if tag == "script":
             attrs_dict = dict(attrs)
             if "src" in attrs_dict:
                 src = attrs_dict["src"]
-                cached_scripts.append(src)
+                self.scripts.append(src)
                 match = re.search(r"c/[^/]*/_", src)
                 if match:
-                    cached_dpl = match.group(0)
-                    cached_time = int(time.time())
+                    self.dpl = match.group(0)
 
 
 def get_data_build_from_html(html_content):
-    global cached_scripts, cached_dpl, cached_time
     parser = ScriptSrcParser()
     parser.feed(html_content)
-    if not cached_scripts:
-        cached_scripts.append("https://chatgpt.com/backend-api/sentinel/sdk.js")
-    if not cached_dpl:
+    scripts, dpl = parser.scripts, parser.dpl
+    if not scripts:
+        scripts.append("https://chatgpt.com/backend-api/sentinel/sdk.js")
+    if not dpl:
         match = re.search(r'<html[^>]*data-build="([^"]*)"', html_content)
         if match:
-            data_build = match.group(1)
-            cached_dpl = data_build
-            cached_time = int(time.time())
-            logger.info(f"Found dpl: {cached_dpl}")
+            dpl = match.group(1)
+            logger.info(f"Found dpl: {dpl}")
+    return scripts, dpl
 
 
-async def get_dpl(service):
-    global cached_scripts, cached_dpl, cached_time
-    if int(time.time()) - cached_time < 15 * 60:
-        return True
-    headers = service.base_headers.copy()
-    cached_scripts = []
-    cached_dpl = ""
+async def fetch_dpl(host_url, headers, proxy=None, impersonate="safari15_3"):
+    client = Client(proxy=proxy, impersonate=impersonate)
     try:
-        if conversation_only:
-            return True
-        r = await service.s.get(f"{service.host_url}/", headers=headers, timeout=5)
+        r = await client.get(f"{host_url}/", headers=headers, timeout=5)
         r.raise_for_status()
-        get_data_build_from_html(r.text)
-        if not cached_dpl:
+        scripts, dpl = get_data_build_from_html(r.text)
+        if not dpl:
             raise Exception("No Cached DPL")
-        else:
-            return True
+        # swap in a complete entry so get_config never sees a half-filled script list
+        dpl_cache[host_url] = {"scripts": scripts, "dpl": dpl, "time": int(time.time())}
+        return True
     except Exception as e:
         logger.info(f"Failed to get dpl: {e}")
-        cached_dpl = None
-        cached_time = int(time.time())
+        entry = dpl_cache.get(host_url)
+        if entry and entry["dpl"]:
+            dpl_cache[host_url] = {**entry, "time": int(time.time())}
+        else:
+            dpl_cache[host_url] = {"scripts": [], "dpl": None, "time": int(time.time())}
         return False
+    finally:
+        await client.close()
+        dpl_tasks.pop(host_url, None)
+
+
+def refresh_dpl(host_url, headers, proxy=None, impersonate="safari15_3"):
+    task = dpl_tasks.get(host_url)
+    if not task:
+        task = asyncio.create_task(fetch_dpl(host_url, headers, proxy, impersonate))
+        dpl_tasks[host_url] = task
+    return task
+
+
+async def get_dpl(service):
+    if conversation_only:
+        return True
+    entry = dpl_cache.get(service.host_url)
+    if entry and int(time.time()) - entry["time"] < 15 * 60:
+        return True
+    task = refresh_dpl(service.host_url, service.base_headers.copy(), service.proxy_url,
+                       service.ua.get("impersonate", "safari15_3"))
+    if entry:
+        return bool(entry["dpl"])
+    return await asyncio.shield(task)
+
+
+def warm_dpl(user_agent):
+    if conversation_only:
+        return
+    headers = {'accept-language': 'en-US,en;q=0.9', 'user-agent': user_agent}
+    for host_url in chatgpt_base_url_list or ["https://chatgpt.com"]:
+        refresh_dpl(host_url, headers, random.choice(proxy_url_list) if proxy_url_list else None)
 
 
 def get_parse_time():
@@ -438,7 +471,10 @@ def get_parse_time():
     return now.strftime(timeLayout) + " GMT-0500 (Eastern Standard Time)"
 
 
-def get_config(user_agent):
+def get_config(user_agent, host_url):
+    entry = dpl_cache.get(host_url, {})
+    cached_scripts = entry.get("scripts")
+    cached_dpl = entry.get("dpl", "")
     core = random.choice(cores)
     screen = random.choice(screens)
     config = [
@@ -461,31 +497,10 @@ def get_config(user_agent):
     return config
 
 
-def get_answer_token(seed, diff, config):
-    start = time.time()
-    answer, solved = generate_answer(seed, diff, config)
-    end = time.time()
-    logger.info(f'diff: {diff}, time: {int((end - start) * 1e6) / 1e3}ms, solved: {solved}')
-    return "gAAAAAB" + answer, solved
-
-
 def generate_answer(seed, diff, config):
-    diff_len = len(diff)
-    seed_encoded = seed.encode()
-    static_config_part1 = (json.dumps(config[:3], separators=(',', ':'), ensure_ascii=False)[:-1] + ',').encode()
-    static_config_part2 = (',' + json.dumps(config[4:9], separators=(',', ':'), ensure_ascii=False)[1:-1] + ',').encode()
-    static_config_part3 = (',' + json.dumps(config[10:], separators=(',', ':'), ensure_ascii=False)[1:]).encode()
-
-    target_diff = bytes.fromhex(diff)
-
-    for i in range(500000):
-        dynamic_json_i = str(i).encode()
-        dynamic_json_j = str(i >> 1).encode()
-        final_json_bytes = static_config_part1 + dynamic_json_i + static_config_part2 + dynamic_json_j + static_config_part3
-        base_encode = pybase64.b64encode(final_json_bytes)
-        hash_value = hashlib.sha3_512(seed_encoded + base_encode).digest()
-        if hash_value[:diff_len] <= target_diff:
-            return base_encode.decode(), True
+    answer = solve_range(seed, diff, config, 0, 500000)
+    if answer:
+        return answer, True
 
     return "wQ8Lk5FbGpA2NcR9dShT6gYjU7VxZ4D" + pybase64.b64encode(f'"{seed}"'.encode()).decode(), False
 
@@ -496,17 +511,10 @@ def get_requirements_token(config):
 
 
 if __name__ == "__main__":
-    # cached_scripts.append(
-    #     "https://cdn.oaistatic.com/_next/static/cXh69klOLzS0Gy2joLDRS/_ssgManifest.js?dpl=453ebaec0d44c2decab71692e1bfe39be35a24b3")
-    # cached_dpl = "453ebaec0d44c2decab71692e1bfe39be35a24b3"
-    # cached_time = int(time.time())
-    # for i in range(10):
-    #     seed = format(random.random())
-    #     diff = "000032"
-    #     config = get_config("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome")
-    #     answer = get_answer_token(seed, diff, config)
-    cached_scripts.append(
-        "https://cdn.oaistatic.com/_next/static/cXh69klOLzS0Gy2joLDRS/_ssgManifest.js?dpl=453ebaec0d44c2decab71692e1bfe39be35a24b3")
-    cached_dpl = "dpl=453ebaec0d44c2decab71692e1bfe39be35a24b3"
-    config = get_config("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36")
+    dpl_cache["https://chatgpt.com"] = {
+        "scripts": ["https://cdn.oaistatic.com/_next/static/cXh69klOLzS0Gy2joLDRS/_ssgManifest.js?dpl=453ebaec0d44c2decab71692e1bfe39be35a24b3"],
+        "dpl": "dpl=453ebaec0d44c2decab71692e1bfe39be35a24b3",
+        "time": int(time.time()),
+    }
+    config = get_config("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36", "https://chatgpt.com")
     get_requirements_token(config)
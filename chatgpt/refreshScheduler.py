@@ -0,0 +1,127 @@
+import asyncio
+import heapq
+import json
+import random
+import time
+
+import pybase64
+
+import chatgpt.globals as globals
+from utils.Logger import logger
+from utils.config import refresh_concurrency
+
+
+def get_token_claims(access_token):
+    try:
+        payload = access_token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        claims = json.loads(pybase64.urlsafe_b64decode(payload))
+        return claims.get("iat"), int(claims["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None, None
+
+
+class RefreshScheduler:
+    # margin and jitter are fractions of each access token's own lifetime: refreshes land in its last 10-25%
+    def __init__(self, concurrency=4, margin=0.1, jitter=0.15, retry_delay=10 * 60, fallback_ttl=5 * 24 * 60 * 60):
+        self.concurrency = concurrency
+        self.margin = margin
+        self.jitter = jitter
+        self.retry_delay = retry_delay
+        self.fallback_ttl = fallback_ttl
+        self.heap = []
+        self.due = {}
+        self.refreshing = set()
+        self.semaphore = None
+        self.wakeup = None
+        self.refresh = None
+        self.task = None
+        self.refreshed = 0
+        self.failed = 0
+
+    def lifetime(self, refresh_token):
+        cached = globals.refresh_map.get(refresh_token)
+        if not cached:
+            return None, None
+        issued_at, expires_at = get_token_claims(cached.get("token", ""))
+        issued_at = int(issued_at or cached.get("timestamp", 0))
+        expires_at = expires_at or cached.get("timestamp", 0) + self.fallback_ttl
+        return expires_at, max(expires_at - issued_at, 0)
+
+    def is_fresh(self, refresh_token):
+        expires_at, lifetime = self.lifetime(refresh_token)
+        return expires_at is not None and time.time() < expires_at - lifetime * self.margin
+
+    def schedule(self, refresh_token, due=None):
+        if due is None:
+            expires_at, lifetime = self.lifetime(refresh_token)
+            if expires_at is None:
+                due = time.time() + random.uniform(0, 60)
+            else:
+                # spread refreshes over the jitter window so tokens issued together do not renew together
+                due = expires_at - lifetime * (self.margin + random.uniform(0, self.jitter))
+        self.due[refresh_token] = due
+        heapq.heappush(self.heap, (due, refresh_token))
+        if self.wakeup:
+            self.wakeup.set()
+
+    async def refresh_token(self, refresh_token):
+        async with self.semaphore:
+            try:
+                await self.refresh(refresh_token, force_refresh=True)
+                self.refreshed += 1
+            except Exception as e:
+                self.failed += 1
+                if not globals.token_pool.is_error(refresh_token):
+                    self.schedule(refresh_token, time.time() + self.retry_delay)
+                logger.info(f"Scheduled refresh of {refresh_token[:10]} failed: {getattr(e, 'detail', e)}")
+            finally:
+                self.refreshing.discard(refresh_token)
+
+    async def run(self):
+        while True:
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                due, refresh_token = heapq.heappop(self.heap)
+                if self.due.get(refresh_token) != due or refresh_token in self.refreshing:
+                    continue
+                del self.due[refresh_token]
+                if not globals.token_pool.is_available(refresh_token):
+                    continue
+                self.refreshing.add(refresh_token)
+                asyncio.create_task(self.refresh_token(refresh_token))
+            timeout = self.heap[0][0] - now if self.heap else None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, refresh_tokens, refresh):
+        if self.task:
+            return
+        self.refresh = refresh
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.wakeup = asyncio.Event()
+        for refresh_token in refresh_tokens:
+            if len(refresh_token) == 45 and refresh_token not in self.due:
+                self.schedule(refresh_token)
+        self.task = asyncio.create_task(self.run())
+        logger.info(f"Refresh scheduler started with {len(self.due)} refresh tokens")
+
+    def add(self, refresh_token):
+        if self.task and len(refresh_token) == 45 and refresh_token not in self.due:
+            self.schedule(refresh_token)
+
+    def stats(self):
+        next_due = min(self.due.values(), default=None)
+        return {
+            "scheduled": len(self.due),
+            "refreshing": len(self.refreshing),
+            "refreshed": self.refreshed,
+            "failed": self.failed,
+            "next_refresh_in": round(max(next_due - time.time(), 0)) if next_due else None,
+        }
+
+
+refresh_scheduler = RefreshScheduler(concurrency=refresh_concurrency)
@@ -1,4 +1,4 @@
-import json
+import asyncio
 import random
 import time
 
@@ -8,27 +8,51 @@ from utils.Client import Client
 from utils.Logger import logger
 from utils.config import proxy_url_list
 import chatgpt.globals as globals
+from chatgpt.stateStore import write_line_file
+from chatgpt.refreshScheduler import refresh_scheduler
 
 
-def save_refresh_map(refresh_map):
-    with open(globals.REFRESH_MAP_FILE, "w") as file:
-        json.dump(refresh_map, file)
+refresh_tasks = {}
+refresh_failures = {}
+refresh_failure_ttl = 60
 
 
 async def rt2ac(refresh_token, force_refresh=False):
-    if not force_refresh and (refresh_token in globals.refresh_map and int(time.time()) - globals.refresh_map.get(refresh_token, {}).get("timestamp", 0) < 5 * 24 * 60 * 60):
+    if not force_refresh and refresh_scheduler.is_fresh(refresh_token):
         access_token = globals.refresh_map[refresh_token]["token"]
         logger.info(f"refresh_token -> access_token from cache")
         return access_token
+    failure = refresh_failures.get(refresh_token)
+    if failure and failure[0] > time.time():
+        raise HTTPException(status_code=failure[1], detail=failure[2])
+    task = refresh_tasks.get(refresh_token)
+    if task is None:
+        task = asyncio.create_task(exchange_refresh_token(refresh_token))
+        refresh_tasks[refresh_token] = task
+        task.add_done_callback(lambda _: refresh_tasks.pop(refresh_token, None))
     else:
-        try:
-            access_token = await chat_refresh(refresh_token)
-            globals.refresh_map[refresh_token] = {"token": access_token, "timestamp": int(time.time())}
-            save_refresh_map(globals.refresh_map)
-            logger.info(f"refresh_token -> access_token with openai: {access_token}")
-            return access_token
-        except HTTPException as e:
-            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        logger.info(f"refresh_token -> access_token joined in-flight refresh")
+    # one exchange per refresh token, a cancelled waiter must not cancel it for the others
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        raise
+
+
+async def exchange_refresh_token(refresh_token):
+    try:
+        access_token = await chat_refresh(refresh_token)
+    except HTTPException as e:
+        refresh_failures[refresh_token] = (time.time() + refresh_failure_ttl, e.status_code, e.detail)
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    refresh_failures.pop(refresh_token, None)
+    globals.refresh_map[refresh_token] = {"token": access_token, "timestamp": int(time.time())}
+    globals.state_store.set("refresh_map", refresh_token, globals.refresh_map[refresh_token])
+    if refresh_scheduler.task:
+        refresh_scheduler.schedule(refresh_token)
+    logger.info(f"refresh_token -> access_token with openai: {access_token}")
+    return access_token
 
 
 async def chat_refresh(refresh_token):
@@ -46,10 +70,8 @@ async def chat_refresh(refresh_token):
             return access_token
         else:
             if "invalid_grant" in r.text or "access_denied" in r.text:
-                if refresh_token not in globals.error_token_list:
-                    globals.error_token_list.append(refresh_token)
-                    with open(globals.ERROR_TOKENS_FILE, "a", encoding="utf-8") as f:
-                        f.write(refresh_token + "\n")
+                if globals.token_pool.mark_error(refresh_token):
+                    await asyncio.to_thread(write_line_file, globals.ERROR_TOKENS_FILE, [refresh_token])
                 raise Exception(r.text)
             else:
                 raise Exception(r.text[:300])
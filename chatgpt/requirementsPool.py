@@ -0,0 +1,109 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+import chatgpt.globals as globals
+from chatgpt.proofofWork import get_config, get_requirements_token, dpl_cache
+from utils.Logger import logger
+from utils.config import requirements_pool_size, requirements_pool_ttl, conversation_only, chatgpt_base_url_list
+
+
+def solve_requirements(user_agent, host_url, count):
+    tokens = []
+    for _ in range(count):
+        config = get_config(user_agent, host_url)
+        tokens.append((time.monotonic(), config, get_requirements_token(config)))
+    return tokens
+
+
+class RequirementsPool:
+    # the config embeds the dpl build of the host it will be posted to, so tokens are pooled per (user agent, host)
+    def __init__(self, size=2, ttl=120, max_pools=256, interval=1):
+        self.size = size
+        self.ttl = ttl
+        self.max_pools = max_pools
+        self.interval = interval
+        self.pools = OrderedDict()
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.hits = 0
+        self.misses = 0
+
+    def track(self, user_agent, host_url):
+        key = (user_agent, host_url)
+        if key in self.pools:
+            self.pools.move_to_end(key)
+            return
+        self.pools[key] = deque(maxlen=self.size)
+        while len(self.pools) > self.max_pools:
+            self.pools.popitem(last=False)
+
+    def get(self, user_agent, host_url):
+        if not self.size:
+            return None
+        self.track(user_agent, host_url)
+        tokens = self.pools[(user_agent, host_url)]
+        deadline = time.monotonic() - self.ttl
+        while tokens:
+            created, config, p = tokens.pop()
+            if created >= deadline:
+                self.hits += 1
+                self.wakeup.set()
+                return config, p
+        self.misses += 1
+        self.wakeup.set()
+        return None
+
+    async def refill(self):
+        if not dpl_cache and not conversation_only:
+            return
+        deadline = time.monotonic() - self.ttl
+        for (user_agent, host_url), tokens in list(self.pools.items()):
+            if host_url not in dpl_cache and not conversation_only:
+                continue
+            while tokens and tokens[0][0] < deadline:
+                tokens.popleft()
+            missing = self.size - len(tokens)
+            if missing > 0:
+                tokens.extend(await asyncio.to_thread(solve_requirements, user_agent, host_url, missing))
+
+    async def run(self):
+        while True:
+            try:
+                await self.refill()
+            except Exception as e:
+                logger.error(f"Failed to refill requirements tokens: {e}")
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if not self.size or self.task:
+            return
+        for user_agent in list(globals.user_agent_map.values())[:self.max_pools]:
+            user_agent = {k.lower(): v for k, v in user_agent.items()}.get("user-agent")
+            if user_agent:
+                for host_url in chatgpt_base_url_list or ["https://chatgpt.com"]:
+                    self.track(user_agent, host_url)
+        self.task = asyncio.create_task(self.run())
+
+    def stats(self):
+        return {
+            "pools": len(self.pools),
+            "ready": sum(len(tokens) for tokens in self.pools.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+requirements_pool = RequirementsPool(size=requirements_pool_size, ttl=requirements_pool_ttl)
+
+
+async def get_requirements(user_agent, host_url):
+    requirements = requirements_pool.get(user_agent, host_url)
+    if requirements:
+        return requirements
+    _, config, p = (await asyncio.to_thread(solve_requirements, user_agent, host_url, 1))[0]
+    return config, p
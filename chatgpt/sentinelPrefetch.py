@@ -0,0 +1,83 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from utils.Logger import logger
+from utils.config import sentinel_prefetch, sentinel_prefetch_ttl
+
+
+class SentinelPrefetcher:
+    def __init__(self, enabled=False, ttl=60, max_bundles=1024):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_bundles = max_bundles
+        self.bundles = OrderedDict()
+        self.priming = {}
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.primed = 0
+        self.failed = 0
+        self.total_age = 0.0
+        self.last_age = 0.0
+
+    def take(self, req_token, model):
+        if not self.enabled or not req_token:
+            return None
+        bundle = self.bundles.pop(req_token, None)
+        if not bundle or bundle["model"] != model:
+            self.misses += 1
+            return None
+        age = time.monotonic() - bundle["created"]
+        if age > self.ttl:
+            self.expired += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.last_age = age
+        self.total_age += age
+        return bundle
+
+    def schedule(self, req_token, model, prime):
+        if not self.enabled or not req_token or req_token in self.priming:
+            return
+        self.priming[req_token] = asyncio.create_task(self.prime(req_token, model, prime))
+
+    async def prime(self, req_token, model, prime):
+        try:
+            bundle = await prime(req_token, model)
+            if bundle:
+                bundle["model"] = model
+                bundle["created"] = time.monotonic()
+                self.bundles[req_token] = bundle
+                self.bundles.move_to_end(req_token)
+                while len(self.bundles) > self.max_bundles:
+                    self.bundles.popitem(last=False)
+                self.primed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.info(f"Failed to prefetch sentinel for {req_token[:40]}: {getattr(e, 'detail', e)}")
+        finally:
+            self.priming.pop(req_token, None)
+
+    def stats(self):
+        now = time.monotonic()
+        ages = [now - bundle["created"] for bundle in self.bundles.values()]
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "bundles": len(self.bundles),
+            "priming": len(self.priming),
+            "primed": self.primed,
+            "failed": self.failed,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+            "avg_age_on_hit": round(self.total_age / self.hits, 3) if self.hits else 0,
+            "last_age_on_hit": round(self.last_age, 3),
+            "oldest_bundle_age": round(max(ages), 3) if ages else 0,
+        }
+
+
+sentinel_prefetcher = SentinelPrefetcher(enabled=sentinel_prefetch, ttl=sentinel_prefetch_ttl)
@@ -0,0 +1,84 @@
+import json
+from json.encoder import encode_basestring_ascii
+
+
+def encode_value(value):
+    if isinstance(value, str):
+        return encode_basestring_ascii(value)
+    if value is None:
+        return "null"
+    return json.dumps(value)
+
+
+# frames are byte-identical to json.dumps of the whole chunk, but only the changing fields are encoded per frame
+class SSEEncoder:
+    def __init__(self, chat_id, created, model, system_fingerprint=None):
+        head = json.dumps({"id": chat_id, "object": "chat.completion.chunk", "created": created, "model": model})
+        self.head = "data: " + head[:-1]
+        self.prefix = self.head + ', "choices": [{"index": 0, "delta": '
+        self.middle = ', "logprobs": null, "finish_reason": '
+        self.fingerprint = ', "system_fingerprint": ' + encode_value(system_fingerprint) if system_fingerprint else ""
+        self.suffix = "}]" + self.fingerprint
+
+    @staticmethod
+    def encode_delta(delta):
+        if not delta:
+            return "{}"
+        return "{" + ", ".join(encode_basestring_ascii(key) + ": " + encode_value(value)
+                               for key, value in delta.items()) + "}"
+
+    def encode(self, delta, finish_reason=None, ids=None):
+        frame = self.prefix + self.encode_delta(delta) + self.middle + encode_value(finish_reason) + self.suffix
+        if ids:
+            message_id, conversation_id = ids
+            frame += ', "message_id": ' + encode_value(message_id) + ', "conversation_id": ' + encode_value(conversation_id)
+        return frame + "}\n\n"
+
+    def encode_usage(self, usage):
+        return self.head + ', "choices": []' + self.fingerprint + ', "usage": ' + json.dumps(usage) + "}\n\n"
+
+
+if __name__ == "__main__":
+    import time
+
+    chunk_new_data = {
+        "id": "chatcmpl-" + "x" * 29,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "gpt-4o",
+        "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "logprobs": None, "finish_reason": None}],
+        "system_fingerprint": "fp_3aa7262c27",
+    }
+    encoder = SSEEncoder(chunk_new_data["id"], chunk_new_data["created"], "gpt-4o", "fp_3aa7262c27")
+    deltas = [{"content": text} for text in ["Hello", " wörld", " \"quoted\"\n", " 你好", " 🙂", "\\", ""]] * 2000
+    deltas.append({})
+
+    for history in (False, True):
+        frames = []
+        for delta in deltas:
+            chunk_new_data["choices"][0]["delta"] = delta
+            chunk_new_data["choices"][0]["finish_reason"] = "stop" if not delta else None
+            if history:
+                chunk_new_data.update({"message_id": "msg-1", "conversation_id": None})
+            frames.append(f"data: {json.dumps(chunk_new_data)}\n\n")
+        encoded = [encoder.encode(delta, "stop" if not delta else None, ("msg-1", None) if history else None)
+                   for delta in deltas]
+        assert frames == encoded, "SSEEncoder output differs from json.dumps"
+    chunk_new_data.pop("message_id")
+    chunk_new_data.pop("conversation_id")
+
+    start = time.perf_counter()
+    for delta in deltas:
+        chunk_new_data["choices"][0]["delta"] = delta
+        chunk_new_data["choices"][0]["finish_reason"] = None
+        f"data: {json.dumps(chunk_new_data)}\n\n"
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for delta in deltas:
+        encoder.encode(delta)
+    encoded = time.perf_counter() - start
+
+    print(f"frames: {len(deltas)}, output byte-identical")
+    print(f"json.dumps envelope: {len(deltas) / legacy:,.0f} frames/s")
+    print(f"SSEEncoder:          {len(deltas) / encoded:,.0f} frames/s")
@@ -0,0 +1,202 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+
+from utils.Logger import logger
+
+
+class StateStore:
+    def __init__(self, path, flush_interval=1):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.created = not os.path.exists(path)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT, UNIQUE (namespace, key))"
+        )
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.pending = {}
+        self.cleared = set()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.writes = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.thread = threading.Thread(target=self.run, name="state-store", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def set(self, namespace, key, value):
+        with self.lock:
+            if (namespace, key) in self.pending:
+                self.coalesced += 1
+            self.pending[(namespace, key)] = json.dumps(value)
+        self.wakeup.set()
+
+    def delete(self, namespace, key):
+        with self.lock:
+            self.pending[(namespace, key)] = None
+        self.wakeup.set()
+
+    def clear(self, namespace):
+        with self.lock:
+            for item in [item for item in self.pending if item[0] == namespace]:
+                del self.pending[item]
+            self.cleared.add(namespace)
+        self.wakeup.set()
+
+    def items(self, namespace):
+        self.flush()
+        with self.db_lock:
+            rows = self.conn.execute(
+                "SELECT key, value FROM state WHERE namespace = ? ORDER BY rowid", (namespace,)
+            ).fetchall()
+        for key, value in rows:
+            yield key, json.loads(value)
+
+    def count(self, namespace):
+        self.flush()
+        with self.db_lock:
+            return self.conn.execute("SELECT COUNT(*) FROM state WHERE namespace = ?", (namespace,)).fetchone()[0]
+
+    def flush(self):
+        # one flush at a time, so a batch put back after a failure can never land on top of a newer one
+        with self.db_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                cleared, self.cleared = self.cleared, set()
+            if not pending and not cleared:
+                return
+            upserts = [(namespace, key, value) for (namespace, key), value in pending.items() if value is not None]
+            deletes = [(namespace, key) for (namespace, key), value in pending.items() if value is None]
+            try:
+                self.conn.execute("BEGIN")
+                self.conn.executemany("DELETE FROM state WHERE namespace = ?", [(namespace,) for namespace in cleared])
+                self.conn.executemany("DELETE FROM state WHERE namespace = ? AND key = ?", deletes)
+                self.conn.executemany(
+                    "INSERT INTO state (namespace, key, value) VALUES (?, ?, ?) "
+                    "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value",
+                    upserts,
+                )
+                self.conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                self.conn.execute("ROLLBACK")
+                logger.error(f"Failed to write state: {e}")
+                # keep the batch for the next flush, anything written or cleared since then is newer and wins
+                with self.lock:
+                    for item, value in pending.items():
+                        if item not in self.pending and item[0] not in self.cleared:
+                            self.pending[item] = value
+                    self.cleared |= cleared
+                return
+        self.writes += len(pending)
+        self.flushes += 1
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            self.flush()
+            # batch whatever else arrives shortly after the first write
+            self.wakeup.wait(self.flush_interval)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join(timeout=5)
+        self.flush()
+        with self.db_lock:
+            self.conn.close()
+
+    def stats(self):
+        with self.lock:
+            pending = len(self.pending)
+        return {
+            "pending": pending,
+            "writes": self.writes,
+            "coalesced": self.coalesced,
+            "flushes": self.flushes,
+        }
+
+
+def import_legacy_files(store, files):
+    for namespace, path in files.items():
+        if not os.path.exists(path):
+            continue
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                if path.endswith(".json"):
+                    items = json.load(f).items()
+                else:
+                    items = [(line.strip(), 1) for line in f if line.strip() and not line.startswith("#")]
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to import {path}: {e}")
+            continue
+        for key, value in items:
+            store.set(namespace, key, value)
+        logger.info(f"Imported {path} into state store")
+    store.flush()
+
+
+# token.txt and error_token.txt stay plain line files that can be edited by hand, they are not mirrored in the store
+line_file_lock = threading.Lock()
+
+
+def read_line_file(path):
+    if not os.path.exists(path):
+        with open(path, "w", encoding="utf-8"):
+            pass
+    with open(path, "r", encoding="utf-8") as f:
+        return list(dict.fromkeys(line.strip() for line in f if line.strip() and not line.startswith("#")))
+
+
+def write_line_file(path, lines, mode="a"):
+    # called through asyncio.to_thread, the lock keeps appends and truncates in call order
+    with line_file_lock:
+        with open(path, mode, encoding="utf-8") as f:
+            f.writelines(line + "\n" for line in lines)
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+    import uuid
+
+    tokens = [str(uuid.uuid4()) for _ in range(20000)]
+    refresh_map = {token: {"token": "eyJhbGciOi" + "x" * 1500, "timestamp": int(time.time())} for token in tokens}
+    rounds = 200
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "refresh_map.json")
+        start = time.perf_counter()
+        for token in tokens[:rounds]:
+            refresh_map[token]["timestamp"] = int(time.time())
+            with open(path, "w") as file:
+                json.dump(refresh_map, file)
+        legacy = (time.perf_counter() - start) / rounds
+
+        store = StateStore(os.path.join(directory, "state.db"))
+        for token, value in refresh_map.items():
+            store.set("refresh_map", token, value)
+        store.flush()
+        start = time.perf_counter()
+        for token in tokens[:rounds]:
+            store.set("refresh_map", token, refresh_map[token])
+        enqueue = (time.perf_counter() - start) / rounds
+        start = time.perf_counter()
+        store.flush()
+        flush = time.perf_counter() - start
+        store.close()
+
+    print(f"tokens: {len(tokens)}, updates: {rounds}")
+    print(f"json.dump whole map: {legacy * 1e3:,.2f} ms/update (on the caller)")
+    print(f"StateStore.set:      {enqueue * 1e6:,.2f} us/update (on the caller)")
+    print(f"StateStore flush:    {flush * 1e3:,.2f} ms for the whole batch (writer thread)")
@@ -0,0 +1,210 @@
+from bisect import bisect_right
+
+import orjson
+
+DONE = "[DONE]"
+
+
+class TextBuffer:
+    def __init__(self, text=""):
+        self.chunks = [text] if text else []
+        self.ends = [len(text)] if text else []
+        self.length = len(text)
+
+    def append(self, text):
+        if text:
+            self.chunks.append(text)
+            self.length += len(text)
+            self.ends.append(self.length)
+
+    def truncate(self, length):
+        text = str(self)[:length]
+        self.chunks = [text] if text else []
+        self.ends = [len(text)] if text else []
+        self.length = len(text)
+
+    def tail(self, start):
+        if start >= self.length:
+            return ""
+        index = bisect_right(self.ends, start)
+        offset = start - (self.ends[index - 1] if index else 0)
+        return self.chunks[index][offset:] + "".join(self.chunks[index + 1:])
+
+    def __getitem__(self, key):
+        if isinstance(key, slice) and key.stop is None and key.step is None and (key.start or 0) >= 0:
+            return self.tail(key.start or 0)
+        return str(self)[key]
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def __str__(self):
+        if len(self.chunks) > 1:
+            self.chunks = ["".join(self.chunks)]
+            self.ends = [self.length]
+        return self.chunks[0] if self.chunks else ""
+
+
+class DeltaDecoder:
+    # applies the backend's v1 delta encoding, keeping appended text in TextBuffers so each event costs its own size
+    def __init__(self):
+        self.state = {}
+        self.path = ""
+        self.op = "add"
+
+    @staticmethod
+    def split_path(path):
+        return [key.replace("~1", "/").replace("~0", "~") for key in path.split("/")[1:]] if path else []
+
+    def resolve(self, keys):
+        target = self.state
+        for key in keys:
+            target = target[int(key)] if isinstance(target, list) else target[key]
+        return target
+
+    def apply(self, delta):
+        if "o" in delta and delta["o"] == "patch":
+            for operation in delta.get("v", []):
+                self.apply_operation(operation.get("p", ""), operation.get("o"), operation.get("v"))
+            return self.state
+        self.path = delta.get("p", self.path)
+        self.op = delta.get("o", self.op)
+        self.apply_operation(self.path, self.op, delta.get("v"))
+        return self.state
+
+    def apply_operation(self, path, op, value):
+        keys = self.split_path(path)
+        if not keys:
+            if op in ("add", "replace"):
+                self.state = value if isinstance(value, dict) else {}
+            elif op == "append" and isinstance(value, dict):
+                self.state.update(value)
+            return
+        parent = self.resolve(keys[:-1])
+        key = int(keys[-1]) if isinstance(parent, list) else keys[-1]
+        if op in ("add", "replace"):
+            if isinstance(parent, list) and key == len(parent):
+                parent.append(value)
+            else:
+                parent[key] = value
+        elif op == "append":
+            current = parent[key] if isinstance(parent, list) or key in parent else None
+            if isinstance(current, TextBuffer):
+                current.append(value)
+            elif isinstance(current, str):
+                parent[key] = TextBuffer(current)
+                parent[key].append(value)
+            elif isinstance(current, list):
+                current.extend(value if isinstance(value, list) else [value])
+            elif isinstance(current, dict):
+                current.update(value)
+            else:
+                parent[key] = value
+        elif op == "truncate":
+            current = parent[key]
+            if isinstance(current, TextBuffer):
+                current.truncate(value)
+            else:
+                parent[key] = current[:value]
+        elif op == "remove":
+            del parent[key]
+
+
+async def parse_events(lines):
+    decoder = None
+    event = None
+    async for line in lines:
+        if not line:
+            event = None
+            continue
+        if line.startswith(b"event:"):
+            event = line[6:].strip()
+            continue
+        if not line.startswith(b"data: "):
+            continue
+        data = line[6:]
+        if data.startswith(b"[DONE]"):
+            yield DONE
+            continue
+        try:
+            value = orjson.loads(data)
+        except orjson.JSONDecodeError:
+            continue
+        if event == b"delta_encoding":
+            decoder = DeltaDecoder()
+        elif event == b"delta" and isinstance(value, dict):
+            decoder = decoder or DeltaDecoder()
+            yield decoder.apply(value)
+        elif isinstance(value, dict):
+            yield value
+
+
+if __name__ == "__main__":
+    import asyncio
+    import json
+    import random
+    import time
+    import types
+
+    from chatgpt.chatFormat import stream_response
+
+    words = [random.choice(["lorem", "ipsum", "dolor", "sit", "amet", "你好", "\n", "`code`"]) for _ in range(8000)]
+    message = {"id": "msg-1", "author": {"role": "assistant"}, "status": "in_progress", "recipient": "all",
+               "content": {"content_type": "text", "parts": [""]}, "metadata": {"model_slug": "gpt-4o"}}
+
+    legacy_lines = []
+    text = ""
+    for word in words:
+        text += " " + word
+        message["content"]["parts"] = [text]
+        legacy_lines += [b"data: " + json.dumps({"message": message, "conversation_id": "conv-1"}).encode(), b""]
+    message.update({"status": "finished_successfully", "end_turn": True})
+    legacy_lines += [b"data: " + json.dumps({"message": message, "conversation_id": "conv-1"}).encode(), b"",
+                     b"data: [DONE]", b""]
+
+    message.update({"status": "in_progress", "end_turn": None, "content": {"content_type": "text", "parts": [""]}})
+    delta_lines = [b"event: delta_encoding", b'data: "v1"', b"", b"event: delta",
+                   b"data: " + json.dumps({"p": "", "o": "add", "v": {"message": message, "conversation_id": "conv-1"}}).encode(), b""]
+    delta_lines += [b"event: delta", b"data: " + json.dumps({"p": "/message/content/parts/0", "o": "append", "v": " " + words[0]}).encode(), b""]
+    for word in words[1:]:
+        delta_lines += [b"event: delta", b"data: " + json.dumps({"v": " " + word}).encode(), b""]
+    delta_lines += [b"event: delta", b"data: " + json.dumps({"p": "", "o": "patch", "v": [
+        {"p": "/message/status", "o": "replace", "v": "finished_successfully"},
+        {"p": "/message/end_turn", "o": "replace", "v": True}]}).encode(), b"", b"data: [DONE]", b""]
+
+    async def lines_of(lines):
+        for line in lines:
+            yield line
+
+    async def json_loads_events(lines):
+        async for line in lines:
+            line = line.decode("utf-8")
+            if line.startswith("data: {"):
+                yield json.loads(line[6:])
+            elif line.startswith("data: [DONE]"):
+                yield DONE
+
+    async def run(events):
+        service = types.SimpleNamespace(history_disabled=True)
+        start = time.perf_counter()
+        content = ""
+        async for frame in stream_response(service, events, "gpt-4o", 1 << 30):
+            if frame.startswith("data: {"):
+                content += json.loads(frame[6:])["choices"][0]["delta"].get("content", "")
+        return time.perf_counter() - start, content
+
+    legacy, legacy_content = asyncio.run(run(json_loads_events(lines_of(legacy_lines))))
+    full, full_content = asyncio.run(run(parse_events(lines_of(legacy_lines))))
+    delta, delta_content = asyncio.run(run(parse_events(lines_of(delta_lines))))
+    assert legacy_content == full_content == delta_content == text
+
+    print(f"events: {len(words)}, answer: {len(text)} chars")
+    print(f"decode + json.loads, full parts: {legacy * 1e3:,.1f} ms")
+    print(f"parse_events, full parts:        {full * 1e3:,.1f} ms")
+    print(f"parse_events, v1 deltas:         {delta * 1e3:,.1f} ms")
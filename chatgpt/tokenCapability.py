@@ -0,0 +1,72 @@
+import heapq
+import time
+
+import chatgpt.globals as globals
+from utils.Logger import logger
+
+paid_models = ["gpt-4"]
+token_capabilities = {}
+models_ttl = 60 * 60
+models_heap = []
+
+
+def record_persona(token, persona):
+    if not token or not persona:
+        return
+    capability = token_capabilities.setdefault(token, {"persona": None, "models": None, "models_time": 0})
+    if capability["persona"] != persona:
+        capability["persona"] = persona
+        logger.info(f"{token[:40]}: persona {persona}")
+        globals.token_pool.refresh(token)
+
+
+def record_models(token, models):
+    slugs = [model.get("slug", "") for model in models or []]
+    if token:
+        capability = token_capabilities.setdefault(token, {"persona": None, "models": None, "models_time": 0})
+        capability["models"] = slugs
+        capability["models_time"] = int(time.time())
+        heapq.heappush(models_heap, (capability["models_time"] + models_ttl, token))
+        globals.token_pool.refresh(token)
+    return slugs
+
+
+def get_cached_models(token, ttl=models_ttl):
+    capability = token_capabilities.get(token)
+    if capability and capability["models"] is not None and int(time.time()) - capability["models_time"] < ttl:
+        return capability["models"]
+    return None
+
+
+def expire_models():
+    # eligibility is cached by the token pool, so a model list going stale has to re-evaluate its token
+    now = int(time.time())
+    while models_heap and models_heap[0][0] <= now:
+        expires_at, token = heapq.heappop(models_heap)
+        capability = token_capabilities.get(token)
+        if capability and capability["models_time"] + models_ttl == expires_at:
+            globals.token_pool.refresh(token)
+
+
+def can_serve(token, model):
+    capability = token_capabilities.get(token)
+    if not capability:
+        # unknown accounts stay eligible, the requirements round trip of their first request probes them
+        return True
+    models = get_cached_models(token)
+    if models is not None:
+        return any(model in slug for slug in models)
+    if capability["persona"] and capability["persona"] != "chatgpt-paid":
+        return model not in paid_models
+    return True
+
+
+def stats():
+    personas = {}
+    for capability in token_capabilities.values():
+        persona = capability["persona"] or "unknown"
+        personas[persona] = personas.get(persona, 0) + 1
+    return {"known": len(token_capabilities), "personas": personas}
+
+
+globals.token_pool.add_filter(can_serve)
@@ -0,0 +1,239 @@
+import asyncio
+import random
+
+
+class IndexedSet:
+    def __init__(self, items=()):
+        self.items = []
+        self.index = {}
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        if item in self.index:
+            return False
+        self.index[item] = len(self.items)
+        self.items.append(item)
+        return True
+
+    def discard(self, item):
+        position = self.index.pop(item, None)
+        if position is None:
+            return False
+        last = self.items.pop()
+        if position < len(self.items):
+            self.items[position] = last
+            self.index[last] = position
+        return True
+
+    def clear(self):
+        self.items.clear()
+        self.index.clear()
+
+    def choice(self):
+        return random.choice(self.items) if self.items else None
+
+    def __getitem__(self, position):
+        return self.items[position]
+
+    def __contains__(self, item):
+        return item in self.index
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+class TokenPool:
+    def __init__(self, tokens=(), error_tokens=(), max_inflight=0, sample_size=2, acquire_timeout=10):
+        self.tokens = []
+        self.token_set = set()
+        self.error_tokens = IndexedSet(error_tokens)
+        self.available = IndexedSet()
+        self.eligible = {}
+        self.filters = []
+        self.count = 0
+        self.max_inflight = max_inflight
+        self.sample_size = sample_size
+        self.acquire_timeout = acquire_timeout
+        self.acquire_timeouts = 0
+        self.inflight = {}
+        self.semaphores = {}
+        for token in tokens:
+            self.add(token)
+
+    def add(self, token):
+        if token in self.token_set:
+            return False
+        self.token_set.add(token)
+        self.tokens.append(token)
+        if token not in self.error_tokens:
+            self.available.add(token)
+            self.refresh(token)
+        return True
+
+    def mark_error(self, token):
+        self.available.discard(token)
+        for eligible in self.eligible.values():
+            eligible.discard(token)
+        return self.error_tokens.add(token)
+
+    def add_filter(self, token_filter):
+        self.filters.append(token_filter)
+        self.eligible.clear()
+
+    def is_eligible(self, token, model):
+        return all(token_filter(token, model) for token_filter in self.filters)
+
+    def refresh(self, token):
+        for model, eligible in self.eligible.items():
+            if token in self.available and self.is_eligible(token, model):
+                eligible.add(token)
+            else:
+                eligible.discard(token)
+
+    def candidates(self, model=None):
+        if model is None or not self.filters:
+            return self.available
+        eligible = self.eligible.get(model)
+        if eligible is None:
+            eligible = IndexedSet(token for token in self.available if self.is_eligible(token, model))
+            self.eligible[model] = eligible
+        return eligible
+
+    def clear(self):
+        self.tokens.clear()
+        self.token_set.clear()
+        self.error_tokens.clear()
+        self.available.clear()
+        self.eligible.clear()
+        self.count = 0
+
+    def is_available(self, token):
+        return token in self.available
+
+    def is_error(self, token):
+        return token in self.error_tokens
+
+    def random_token(self, model=None):
+        return self.candidates(model).choice()
+
+    def next_token(self, model=None):
+        candidates = self.candidates(model)
+        if not candidates:
+            return None
+        return candidates[self.rotate(len(candidates))]
+
+    def rotate(self, size):
+        self.count = (self.count + 1) % size
+        return self.count
+
+    def load(self, token):
+        return self.inflight.get(token, 0)
+
+    def is_saturated(self, token):
+        return bool(self.max_inflight) and self.load(token) >= self.max_inflight
+
+    def least_loaded_token(self, model=None, randomly=True):
+        candidates = self.candidates(model)
+        if not candidates:
+            return None
+        size = len(candidates)
+        if size <= 8 * self.sample_size:
+            # scan from a random or rotating start so idle accounts share sequential traffic,
+            # a token only wins over an earlier one when it is strictly less busy
+            start = random.randrange(size) if randomly else self.rotate(size)
+            return min((candidates[(start + i) % size] for i in range(size)), key=self.load)
+        # power of d choices: the least busy of a small sample, resampled while the sample is all at max_inflight
+        for _ in range(4):
+            if randomly:
+                sample = [candidates.choice() for _ in range(self.sample_size)]
+            else:
+                start = self.rotate(size)
+                sample = [candidates[(start + i) % size] for i in range(self.sample_size)]
+            token = min(sample, key=self.load)
+            if not self.is_saturated(token):
+                return token
+        return next((token for token in candidates if not self.is_saturated(token)), token)
+
+    async def acquire(self, token):
+        if self.max_inflight:
+            semaphore = self.semaphores.get(token)
+            if semaphore is None:
+                semaphore = asyncio.Semaphore(self.max_inflight)
+                self.semaphores[token] = semaphore
+            try:
+                await asyncio.wait_for(semaphore.acquire(), self.acquire_timeout)
+            except asyncio.TimeoutError:
+                self.acquire_timeouts += 1
+                return False
+        self.inflight[token] = self.inflight.get(token, 0) + 1
+        return True
+
+    def release(self, token):
+        count = self.inflight.get(token, 0) - 1
+        if count > 0:
+            self.inflight[token] = count
+        else:
+            self.inflight.pop(token, None)
+        # semaphores are kept for the life of the token: dropping one with a waiter queued on it would let the
+        # next acquire start on a fresh semaphore and exceed max_inflight
+        semaphore = self.semaphores.get(token)
+        if semaphore:
+            semaphore.release()
+
+    def seeded_token(self, seed):
+        if not self.available:
+            return None
+        return self.available[hash(seed) % len(self.available)]
+
+    def available_tokens(self):
+        return list(self.available)
+
+    def stats(self):
+        return {
+            "tokens": len(self.tokens),
+            "available": len(self.available),
+            "error": len(self.error_tokens),
+            "inflight": sum(self.inflight.values()),
+            "busy_tokens": len(self.inflight),
+            "max_inflight_per_token": max(self.inflight.values(), default=0),
+            "acquire_timeouts": self.acquire_timeouts,
+        }
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+if __name__ == "__main__":
+    import time
+    import uuid
+
+    tokens = [str(uuid.uuid4()) for _ in range(100000)]
+    error_tokens = tokens[::10]
+    rounds = 10000
+
+    start = time.perf_counter()
+    for _ in range(rounds // 100):
+        available_token_list = list(set(tokens) - set(error_tokens))
+        random.choice(available_token_list)
+    legacy = (time.perf_counter() - start) / (rounds // 100)
+
+    pool = TokenPool(tokens, error_tokens)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        pool.random_token()
+        pool.next_token()
+    pooled = (time.perf_counter() - start) / rounds / 2
+
+    start = time.perf_counter()
+    for token in tokens[1:rounds:2]:
+        pool.mark_error(token)
+    mark_error = (time.perf_counter() - start) / (rounds // 2)
+
+    print(f"tokens: {len(tokens)}, available: {len(pool.available)}")
+    print(f"set difference + choice: {legacy * 1e6:,.1f} us/request")
+    print(f"TokenPool selection:     {pooled * 1e6:,.3f} us/request")
+    print(f"TokenPool mark_error:    {mark_error * 1e6:,.3f} us/call")
@@ -0,0 +1,51 @@
+import time
+from collections import OrderedDict
+
+from utils.config import upload_cache_ttl
+
+
+class UploadCache:
+    def __init__(self, ttl=3600, max_entries=4096):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def get(self, account, digest, use_case):
+        if not self.ttl:
+            return None
+        key = (account, digest, use_case)
+        entry = self.entries.get(key)
+        if entry and time.monotonic() - entry[1] < self.ttl:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += entry[0]["size_bytes"]
+            return dict(entry[0], cached=True)
+        if entry:
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, account, digest, use_case, file_meta):
+        if not self.ttl:
+            return
+        key = (account, digest, use_case)
+        self.entries[key] = (file_meta, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+            "bytes_saved": self.bytes_saved,
+        }
+
+
+upload_cache = UploadCache(ttl=upload_cache_ttl)
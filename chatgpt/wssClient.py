@@ -1,15 +1,9 @@
-import json
 import time
 
 from utils.Logger import logger
 import chatgpt.globals as globals
 
 
-def save_wss_map(wss_map):
-    with open(globals.WSS_MAP_FILE, "w") as file:
-        json.dump(wss_map, file)
-
-
 async def token2wss(token):
     if not token:
         return False, None
@@ -32,5 +26,5 @@ async def set_wss(token, wss_mode, wss_url=None):
     if not token:
         return True
     globals.wss_map[token] = {"timestamp": int(time.time()), "wss_url": wss_url, "wss_mode": wss_mode}
-    save_wss_map(globals.wss_map)
+    globals.state_store.set("wss_map", token, globals.wss_map[token])
     return True
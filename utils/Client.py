@@ -1,10 +1,88 @@
-import random
+import time
+from collections import deque
 
 from curl_cffi.requests import AsyncSession
 
+from utils.Logger import logger
+from utils.config import session_pool_size, session_idle_timeout
+
+
+class SessionPool:
+    def __init__(self, max_size=64, idle_timeout=300):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.idle_count = 0
+        self.expired = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def acquire(self, proxy, impersonate, verify):
+        key = (proxy, impersonate, verify)
+        sessions = self.idle.get(key)
+        deadline = time.monotonic() - self.idle_timeout
+        while sessions:
+            session, released_at = sessions.pop()
+            self.idle_count -= 1
+            if released_at < deadline:
+                self.evictions += 1
+                self.expired.append(session)
+                continue
+            self.hits += 1
+            return session
+        self.misses += 1
+        proxies = {"http": proxy, "https": proxy}
+        return AsyncSession(proxies=proxies, impersonate=impersonate, verify=verify)
+
+    async def release(self, proxy, impersonate, verify, session):
+        key = (proxy, impersonate, verify)
+        session.cookies.clear()
+        await self.evict_idle()
+        if self.idle_count >= self.max_size:
+            self.evictions += 1
+            await self.close_session(session)
+            return
+        self.idle.setdefault(key, deque()).append((session, time.monotonic()))
+        self.idle_count += 1
+
+    async def evict_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        for key in list(self.idle.keys()):
+            sessions = self.idle[key]
+            while sessions and sessions[0][1] < deadline:
+                session, _ = sessions.popleft()
+                self.idle_count -= 1
+                self.evictions += 1
+                self.expired.append(session)
+            if not sessions:
+                del self.idle[key]
+        while self.expired:
+            await self.close_session(self.expired.pop())
+
+    @staticmethod
+    async def close_session(session):
+        try:
+            await session.close()
+        except Exception as e:
+            logger.debug(f"Failed to close session: {e}")
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "idle": self.idle_count,
+            "keys": len(self.idle),
+        }
+
+
+session_pool = SessionPool(max_size=session_pool_size, idle_timeout=session_idle_timeout)
+
 
 class Client:
     def __init__(self, proxy=None, timeout=15, verify=True, impersonate='safari15_3'):
+        self.proxy = proxy
         self.proxies = {"http": proxy, "https": proxy}
         self.timeout = timeout
         self.verify = verify
@@ -15,10 +93,12 @@ class Client:
         # self.ja3 = ""
         # self.akamai = ""
         # ja3=self.ja3, akamai=self.akamai
-        self.session = AsyncSession(proxies=self.proxies, timeout=self.timeout, impersonate=self.impersonate, verify=self.verify)
-        self.session2 = AsyncSession(proxies=self.proxies, timeout=self.timeout, impersonate=self.impersonate, verify=self.verify)
+        self.session = session_pool.acquire(self.proxy, self.impersonate, self.verify)
+        self.session2 = session_pool.acquire(self.proxy, self.impersonate, self.verify)
+        self.streams = []
 
     async def post(self, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
         r = await self.session.post(*args, **kwargs)
         return r
 
@@ -26,31 +106,45 @@ class Client:
         if self.session:
             headers = headers or self.session.headers
             cookies = cookies or self.session.cookies
+        kwargs.setdefault("timeout", self.timeout)
         r = await self.session2.post(*args, headers=headers, cookies=cookies, **kwargs)
+        if kwargs.get("stream"):
+            self.streams.append(r)
         return r
 
     async def get(self, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
         r = await self.session.get(*args, **kwargs)
         return r
 
     async def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
         r = await self.session.request(*args, **kwargs)
+        if kwargs.get("stream"):
+            self.streams.append(r)
         return r
 
     async def put(self, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
         r = await self.session.put(*args, **kwargs)
         return r
 
+    @staticmethod
+    async def close_stream(r):
+        # the pooled session only gets its curl handle back once the transfer ends
+        try:
+            if r.quit_now:
+                r.quit_now.set()
+            await r.aclose()
+        except Exception:
+            pass
+
     async def close(self):
-        if self.session:
-            try:
-                await self.session.close()
-                del self.session
-            except Exception:
-                pass
-        if self.session2:
-            try:
-                await self.session2.close()
-                del self.session2
-            except Exception:
-                pass
+        while self.streams:
+            await self.close_stream(self.streams.pop())
+        session, self.session = self.session, None
+        if session:
+            await session_pool.release(self.proxy, self.impersonate, self.verify, session)
+        session2, self.session2 = self.session2, None
+        if session2:
+            await session_pool.release(self.proxy, self.impersonate, self.verify, session2)
@@ -25,6 +25,8 @@ chatgpt_base_url = os.getenv('CHATGPT_BASE_URL', 'https://chatgpt.com').replace(
 auth_key = os.getenv('AUTH_KEY', None)
 user_agents = os.getenv('USER_AGENTS', '[]')
 random_token = is_true(os.getenv('RANDOM_TOKEN', True))
+token_max_inflight = int(os.getenv('TOKEN_MAX_INFLIGHT', 0))
+token_acquire_timeout = int(os.getenv('TOKEN_ACQUIRE_TIMEOUT', 10))
 
 ark0se_token_url = os.getenv('ARK' + 'OSE_TOKEN_URL', '').replace(' ', '')
 if not ark0se_token_url:
@@ -37,13 +39,35 @@ turnstile_solver_url = os.getenv('TURNSTILE_SOLVER_URL', None)
 
 history_disabled = is_true(os.getenv('HISTORY_DISABLED', True))
 pow_difficulty = os.getenv('POW_DIFFICULTY', '000032')
+pow_workers = int(os.getenv('POW_WORKERS', os.cpu_count() or 1))
+pow_timeout = int(os.getenv('POW_TIMEOUT', 10))
+requirements_pool_size = int(os.getenv('REQUIREMENTS_POOL_SIZE', 2))
+requirements_pool_ttl = int(os.getenv('REQUIREMENTS_POOL_TTL', 120))
+sentinel_prefetch = is_true(os.getenv('SENTINEL_PREFETCH', False))
+sentinel_prefetch_ttl = int(os.getenv('SENTINEL_PREFETCH_TTL', 60))
 retry_times = int(os.getenv('RETRY_TIMES', 3))
 enable_gateway = is_true(os.getenv('ENABLE_GATEWAY', False))
 conversation_only = is_true(os.getenv('CONVERSATION_ONLY', False))
 enable_limit = is_true(os.getenv('ENABLE_LIMIT', True))
 upload_by_url = is_true(os.getenv('UPLOAD_BY_URL', False))
+upload_concurrency = int(os.getenv('UPLOAD_CONCURRENCY', 4))
+upload_cache_ttl = int(os.getenv('UPLOAD_CACHE_TTL', 3600))
+file_cache_size = int(os.getenv('FILE_CACHE_SIZE', 256))
+file_cache_memory = int(os.getenv('FILE_CACHE_MEMORY', 32))
+file_cache_max_object = int(os.getenv('FILE_CACHE_MAX_OBJECT', 20))
+file_spool_memory = int(os.getenv('FILE_SPOOL_MEMORY', 4))
+upload_block_size = int(os.getenv('UPLOAD_BLOCK_SIZE', 4))
+image_downscale = is_true(os.getenv('IMAGE_DOWNSCALE', False))
+image_workers = int(os.getenv('IMAGE_WORKERS', 2))
 check_model = is_true(os.getenv('CHECK_MODEL', False))
+stream_delta_encoding = is_true(os.getenv('STREAM_DELTA_ENCODING', False))
 scheduled_refresh = is_true(os.getenv('SCHEDULED_REFRESH', False))
+refresh_concurrency = int(os.getenv('REFRESH_CONCURRENCY', 4))
+
+session_pool_size = int(os.getenv('SESSION_POOL_SIZE', 64))
+session_idle_timeout = int(os.getenv('SESSION_IDLE_TIMEOUT', 300))
+tiktoken_cache_dir = os.getenv('TIKTOKEN_CACHE_DIR', os.path.join('data', 'tiktoken'))
+os.environ['TIKTOKEN_CACHE_DIR'] = tiktoken_cache_dir
 
 authorization_list = authorization.split(',') if authorization else []
 chatgpt_base_url_list = chatgpt_base_url.split(',') if chatgpt_base_url else []
@@ -66,16 +90,38 @@ logger.info("------------------------- Request --------------------------")
 logger.info("CHATGPT_BASE_URL:  " + str(chatgpt_base_url_list))
 logger.info("PROXY_URL:         " + str(proxy_url_list))
 logger.info("EXPORT_PROXY_URL:  " + str(export_proxy_url))
+logger.info("SESSION_POOL_SIZE: " + str(session_pool_size))
+logger.info("SESSION_IDLE_TIMEOUT: " + str(session_idle_timeout))
 logger.info("---------------------- Functionality -----------------------")
 logger.info("HISTORY_DISABLED:  " + str(history_disabled))
 logger.info("POW_DIFFICULTY:    " + str(pow_difficulty))
+logger.info("POW_WORKERS:       " + str(pow_workers))
+logger.info("POW_TIMEOUT:       " + str(pow_timeout))
+logger.info("REQUIREMENTS_POOL_SIZE: " + str(requirements_pool_size))
+logger.info("REQUIREMENTS_POOL_TTL: " + str(requirements_pool_ttl))
+logger.info("SENTINEL_PREFETCH: " + str(sentinel_prefetch))
+logger.info("SENTINEL_PREFETCH_TTL: " + str(sentinel_prefetch_ttl))
 logger.info("RETRY_TIMES:       " + str(retry_times))
 logger.info("CONVERSATION_ONLY: " + str(conversation_only))
 logger.info("ENABLE_LIMIT:      " + str(enable_limit))
 logger.info("UPLOAD_BY_URL:     " + str(upload_by_url))
+logger.info("UPLOAD_CONCURRENCY: " + str(upload_concurrency))
+logger.info("UPLOAD_CACHE_TTL:  " + str(upload_cache_ttl))
+logger.info("FILE_CACHE_SIZE:   " + str(file_cache_size))
+logger.info("FILE_CACHE_MEMORY: " + str(file_cache_memory))
+logger.info("FILE_CACHE_MAX_OBJECT: " + str(file_cache_max_object))
+logger.info("FILE_SPOOL_MEMORY: " + str(file_spool_memory))
+logger.info("UPLOAD_BLOCK_SIZE: " + str(upload_block_size))
+logger.info("IMAGE_DOWNSCALE:   " + str(image_downscale))
+logger.info("IMAGE_WORKERS:     " + str(image_workers))
 logger.info("CHECK_MODEL:       " + str(check_model))
+logger.info("STREAM_DELTA_ENCODING: " + str(stream_delta_encoding))
+logger.info("TIKTOKEN_CACHE_DIR: " + str(tiktoken_cache_dir))
 logger.info("SCHEDULED_REFRESH: " + str(scheduled_refresh))
+logger.info("REFRESH_CONCURRENCY: " + str(refresh_concurrency))
 logger.info("RANDOM_TOKEN:      " + str(random_token))
+logger.info("TOKEN_MAX_INFLIGHT: " + str(token_max_inflight))
+logger.info("TOKEN_ACQUIRE_TIMEOUT: " + str(token_acquire_timeout))
 logger.info("------------------------- Gateway --------------------------")
 logger.info("ENABLE_GATEWAY:    " + str(enable_gateway))
 
@@ -14,7 +14,7 @@ async def async_retry(func, *args, max_retries=retry_times, **kwargs):
                 logger.error(f"Throw an exception {e.status_code}, {e.detail}")
                 if e.status_code == 500:
                     raise HTTPException(status_code=500, detail="Server error")
-                raise HTTPException(status_code=e.status_code, detail=e.detail)
+                raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
             logger.info(f"Retry {attempt + 1} status code {e.status_code}, {e.detail}. Retrying...")
 
 
@@ -28,5 +28,5 @@ def retry(func, *args, max_retries=retry_times, **kwargs):
                 logger.error(f"Throw an exception {e.status_code}, {e.detail}")
                 if e.status_code == 500:
                     raise HTTPException(status_code=500, detail="Server error")
-                raise HTTPException(status_code=e.status_code, detail=e.detail)
+                raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
             logger.error(f"Retry {attempt + 1} status code {e.status_code}, {e.detail}. Retrying...")